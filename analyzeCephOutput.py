@@ -1,19 +1,295 @@
-
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import os
+import re
+import sys
 import json
+import array
+import heapq
+import argparse
+import datetime
+
+READ_CHUNK_SIZE = 1024 * 1024
+SECONDS_PER_DAY = 24 * 60 * 60
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4, "P": 1024**5}
+
+def parse_size(size: str) -> int:
+  """Parse a size like 1073741824, 100G or 1.5TiB into bytes."""
+  match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGTP]?)(i?B)?\s*", size, re.IGNORECASE)
+  if match is None:
+    raise argparse.ArgumentTypeError(f"invalid size {size!r}")
+  return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+def iter_json_array(f) -> Iterator[Any]:
+  """
+  Yield the elements of the JSON array in the text file `f` one by one.
+  Only the current chunk of the file is held in memory, not the whole array.
+  """
+  decoder = json.JSONDecoder()
+  buffer = ""
+  position = 0
+  eof = False
+
+  def fill() -> bool:
+    nonlocal buffer, position, eof
+    chunk = f.read(READ_CHUNK_SIZE)
+    eof = len(chunk) == 0
+    buffer = buffer[position:] + chunk
+    position = 0
+    return not eof
+
+  def skip_whitespace():
+    nonlocal position
+    while True:
+      while position < len(buffer) and buffer[position].isspace():
+        position += 1
+      if position < len(buffer) or not fill():
+        return
+
+  skip_whitespace()
+  if buffer[position:position + 1] != "[":
+    raise ValueError("Expected a JSON array")
+  position += 1
+  skip_whitespace()
+  if buffer[position:position + 1] == "]":
+    return
+  while True:
+    try:
+      element, end = decoder.raw_decode(buffer, position)
+    except json.JSONDecodeError:
+      if not fill():
+        raise
+      continue
+    if end == len(buffer) and not eof and fill():
+      # A number at the end of the buffer may continue in the next chunk
+      continue
+    position = end
+    yield element
+    skip_whitespace()
+    separator = buffer[position:position + 1]
+    position += 1
+    if separator == "]":
+      return
+    if separator != ",":
+      raise ValueError(f"Expected , or ] after an array element, got {separator!r}")
+    skip_whitespace()
+
+class PrefixTree:
+  """
+  Usage rolled up by path prefix, for all prefixes with up to `depth` components, e.g. /volumes/tenant/project for 3.
+  The prefixes are numbered in the order they are seen, starting with the ones in `paths`, and their sizes are kept in
+  a list indexed by that number, which is the column of the prefix in a UsageStore.
+  """
+  def __init__(self, depth: int, paths: List[str] = []):
+    self.depth = depth
+    self.ids: Dict[str, int] = {}
+    self.paths: List[str] = []
+    self.sizes: List[int] = []
+    self._get_id("/")
+    for path in paths:
+      self._get_id(path)
+
+  def _get_id(self, prefix: str) -> int:
+    prefix_id = self.ids.get(prefix)
+    if prefix_id is None:
+      prefix_id = self.ids[prefix] = len(self.paths)
+      self.paths.append(prefix)
+      self.sizes.append(0)
+    return prefix_id
+
+  def add(self, path: str, size: int):
+    self.sizes[0] += size
+    prefix = ""
+    for component in [component for component in path.split("/") if component][:self.depth]:
+      prefix += "/" + component
+      self.sizes[self._get_id(prefix)] += size
+
+  def get_children(self) -> Dict[int, List[int]]:
+    """Return the ids of the children of every prefix which has children."""
+    children: Dict[int, List[int]] = {}
+    for prefix_id, path in enumerate(self.paths[1:], start=1):
+      children.setdefault(self.ids[get_parent(path)], []).append(prefix_id)
+    return children
+
+def get_parent(path: str) -> str:
+  return path.rsplit("/", 1)[0] or "/"
+
+def get_depth(path: str) -> int:
+  return 0 if path == "/" else path.count("/")
+
+def print_rollup(tree: PrefixTree, top: int):
+  """Print the tree of prefixes with their usage, with the `top` largest children of each prefix."""
+  children = tree.get_children()
+  stack = [0]
+  while stack:
+    prefix_id = stack.pop()
+    path = tree.paths[prefix_id]
+    name = path if prefix_id == 0 else path.rsplit("/", 1)[1]
+    print(f"{tree.sizes[prefix_id] / 1024**3:12.1f} GiB  {'  ' * get_depth(path)}{name}")
+    largest = sorted(children.get(prefix_id, []), key=lambda child: tree.sizes[child], reverse=True)[:top]
+    stack.extend(reversed(largest))
+
+class UsageStore:
+  """
+  Columnar on-disk store of successive rollups of dumps in a directory:
+  - paths.txt lists the prefixes, the line number of a prefix is its column
+  - every dump is stored as an array of little endian uint64 sizes, one per column. The arrays of older dumps are
+    shorter, as prefixes seen first in later dumps are appended as new columns.
+  - index.json contains the rollup depth, the number of columns and the time and array file of every dump
+  """
+  def __init__(self, directory: str):
+    self.directory = directory
+    self.index: Dict[str, Any] = {"depth": None, "dumps": []}
+    self.paths: List[str] = []
+    if os.path.exists(self._get_file("index.json")):
+      with open(self._get_file("index.json")) as f:
+        self.index = json.load(f)
+      with open(self._get_file("paths.txt")) as f:
+        # paths.txt can have more lines than the index, written by an interrupted dump
+        self.paths = f.read().splitlines()[:self.index.get("num_paths")]
+
+  def _get_file(self, name: str) -> str:
+    return os.path.join(self.directory, name)
+
+  def add_dump(self, tree: PrefixTree, timestamp: float):
+    """Store the rollup of a dump. `tree` has to be created with the paths of this store."""
+    assert tree.paths[:len(self.paths)] == self.paths
+    os.makedirs(self.directory, exist_ok=True)
+    sizes = array.array("Q", tree.sizes)
+    if sys.byteorder == "big":
+      sizes.byteswap()
+    dump_file = f"dump-{len(self.index['dumps']):06d}.u64"
+    with open(self._get_file(dump_file), "wb") as f:
+      sizes.tofile(f)
+    with open(self._get_file("paths.txt"), "a") as f:
+      # Drop the paths of an interrupted dump, which are not in the index
+      f.truncate(sum(len(path.encode(f.encoding)) + 1 for path in self.paths))
+      f.writelines(path + "\n" for path in tree.paths[len(self.paths):])
+    self.paths = list(tree.paths)
+    self.index["depth"] = tree.depth
+    self.index["num_paths"] = len(self.paths)
+    self.index["dumps"].append({"time": timestamp, "file": dump_file})
+    # The index is replaced last, so an interrupted dump is never referenced
+    with open(self._get_file("index.json.tmp"), "w") as f:
+      json.dump(self.index, f, indent=1)
+    os.replace(self._get_file("index.json.tmp"), self._get_file("index.json"))
+
+  def load(self, window: Optional[int] = None) -> Tuple[Any, Any]:
+    """
+    Return the times of the last `window` dumps (all if None) as numpy array in seconds
+    and their sizes as matrix with a row per dump and a column per prefix.
+    """
+    import numpy as np
+    dumps = sorted(self.index["dumps"], key=lambda dump: dump["time"])[-window if window else None:]
+    times = np.array([dump["time"] for dump in dumps], dtype=np.float64)
+    sizes = np.zeros((len(dumps), len(self.paths)), dtype=np.float64)
+    for row, dump in enumerate(dumps):
+      dump_sizes = np.fromfile(self._get_file(dump["file"]), dtype="<u8")
+      sizes[row, :len(dump_sizes)] = dump_sizes
+    return times, sizes
+
+def print_growth(store: UsageStore, window: Optional[int], top: int):
+  """Print the fastest growing prefixes of every depth, by the linear regression of their sizes over the dumps."""
+  try:
+    import numpy as np
+  except ImportError:
+    sys.exit("The growth report needs numpy.")
+  times, sizes = store.load(window)
+  if len(times) < 2:
+    sys.exit(f"The growth report needs at least two dumps in the store, it has {len(times)}.")
+  days = (times - times[-1]) / SECONDS_PER_DAY
+  centered_days = days - days.mean()
+  if not centered_days.any():
+    sys.exit("The growth report needs dumps at different times.")
+  # Least squares slope of every column at once, in bytes per day
+  slopes = centered_days @ (sizes - sizes.mean(axis=0)) / (centered_days @ centered_days)
+  last_interval = days[-1] - days[-2]
+  last_growth = (sizes[-1] - sizes[-2]) / last_interval if last_interval > 0 else np.full(len(store.paths), np.nan)
+  relative = np.divide(slopes, sizes[-1], out=np.full(len(store.paths), np.nan), where=sizes[-1] > 0) * 100
+  depths = np.array([get_depth(path) for path in store.paths])
+
+  first = datetime.datetime.fromtimestamp(times[0])
+  last = datetime.datetime.fromtimestamp(times[-1])
+  print(f"Growth over {len(times)} dumps from {first:%Y-%m-%d %H:%M} to {last:%Y-%m-%d %H:%M}:")
+  for depth in range(1, depths.max(initial=0) + 1):
+    columns = np.flatnonzero(depths == depth)
+    fastest = columns[np.argsort(-slopes[columns], kind="stable")[:top]]
+    print(f"Fastest growing prefixes at depth {depth}:")
+    print(f"{'size GiB':>12} {'GiB/day':>10} {'last GiB/day':>13} {'%/day':>7}  path")
+    for column in fastest:
+      print(f"{sizes[-1, column] / 1024**3:12.1f} {slopes[column] / 1024**3:10.2f} {last_growth[column] / 1024**3:13.2f} "
+            f"{relative[column]:7.2f}  {store.paths[column]}")
+
+def parse_time(time: str) -> float:
+  try:
+    return datetime.datetime.fromisoformat(time).timestamp()
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"invalid ISO 8601 time {time!r}")
 
 def main():
-  with open("cephVolumes.json") as f:
-    data = json.load(f)
+  parser = argparse.ArgumentParser(description="Analyze a dump of the ceph volumes as JSON array of entries with bytes_used and path.")
+  parser.add_argument("file", nargs="?", default="cephVolumes.json",
+                      help="The ceph volume dump. Defaults to cephVolumes.json")
+  parser.add_argument("-t", "--threshold", default=100 * 1024**3, type=parse_size,
+                      help="List the entries using more than this, e.g. 500G. Defaults to 100G")
+  parser.add_argument("-k", "--top", default=10, type=int,
+                      help="Report the k largest entries, children per prefix and fastest growing prefixes per depth. Defaults to 10")
+  parser.add_argument("-d", "--depth", type=int,
+                      help="Roll up the usage by path prefixes with up to this many components and print them as tree. "
+                           "Defaults to the depth of --store or 3")
+  parser.add_argument("-s", "--store",
+                      help="Add the rollup of the dump to this usage store directory, see --growth")
+  parser.add_argument("--time", type=parse_time,
+                      help="The time of the dump in ISO 8601 for --store. Defaults to the modification time of the file")
+  parser.add_argument("-g", "--growth", action="store_true",
+                      help="Only report the fastest growing prefixes of the dumps in --store, needs numpy")
+  parser.add_argument("-w", "--window", type=int,
+                      help="Only use the last n dumps for --growth. Defaults to all")
+  args = parser.parse_args()
+
+  store = UsageStore(args.store) if args.store is not None else None
+  if args.growth:
+    if store is None:
+      parser.error("--growth needs --store")
+    print_growth(store, args.window, args.top)
+    return
+  tree = None
+  if args.depth is not None or store is not None:
+    depth = args.depth or (store.index["depth"] if store is not None else None) or 3
+    if store is not None and store.index["depth"] not in (None, depth):
+      parser.error(f"The store has depth {store.index['depth']}")
+    tree = PrefixTree(depth, store.paths if store is not None else [])
 
   size_sum = 0
+  num_entries = 0
+  # Min heap of the largest entries so far, its smallest entry is replaced by larger ones
+  top: List[Tuple[int, int, str]] = []
 
-  for entry in data:
-    size = entry["bytes_used"]
-    path = entry["path"]
-    size_sum += size
-    if size > 1024*1024*1024*100:
-      print(f"Found entry with {size=} and {path=}")
+  with open(args.file) as f:
+    for entry in iter_json_array(f):
+      size = entry["bytes_used"]
+      path = entry["path"]
+      if tree is not None:
+        tree.add(path, size)
+      size_sum += size
+      num_entries += 1
+      if size > args.threshold:
+        print(f"Found entry with {size=} and {path=}")
+      if len(top) < args.top:
+        heapq.heappush(top, (size, -num_entries, path))
+      elif top and size > top[0][0]:
+        heapq.heapreplace(top, (size, -num_entries, path))
   print(f"{size_sum = }")
 
+  print(f"Top {len(top)} of {num_entries} entries:")
+  for size, _, path in sorted(top, reverse=True):
+    print(f"{size / 1024**3:12.1f} GiB  {path}")
+
+  if tree is not None and args.depth is not None:
+    print(f"Usage by prefix up to depth {tree.depth}:")
+    print_rollup(tree, args.top)
+  if store is not None:
+    store.add_dump(tree, args.time if args.time is not None else os.path.getmtime(args.file))
+    print(f"Added the dump to {args.store}, it has {len(store.index['dumps'])} dumps.")
+
 if __name__ == "__main__":
   main()
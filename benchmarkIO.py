@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+from typing import List, Tuple, Dict, Any, Optional
+
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import socket
+import argparse
+import datetime
+import threading
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+# The scenarios of test_io.sh: number of tasks and bytes per task
+SCENARIOS = "1@100M,10@1K,100@1K,1000@1K,2000@1K,5000@1K,10@1M,100@1M,1000@1M,10@10M,50@10M"
+SOURCE_SIZE = 100 * 1024 * 1024
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+# The test data and the flags of the files, set before the workers are started and inherited by forked processes
+_source: Optional[mmap.mmap] = None
+_direct = False
+_buffers = threading.local()
+
+
+def parse_scenarios(scenarios: str) -> List[Tuple[int, int]]:
+    """Parse scenarios like `10@1K,50@10M` into (tasks, bytes per task)."""
+    parsed = []
+    for scenario in scenarios.split(","):
+        match = re.fullmatch(r"\s*(\d+)@(\d+)([KMG]?)\s*", scenario, re.IGNORECASE)
+        if match is None:
+            raise argparse.ArgumentTypeError(f"invalid scenario {scenario!r}, use TASKS@SIZE like 100@1K")
+        tasks, size = int(match.group(1)), int(match.group(2)) * UNITS[match.group(3).upper()]
+        if tasks < 1:
+            raise argparse.ArgumentTypeError(f"invalid scenario {scenario!r}, it needs at least one task")
+        if size < 1 or size > SOURCE_SIZE:
+            raise argparse.ArgumentTypeError(f"invalid scenario {scenario!r}, the size must be between 1 byte and {_format_size(SOURCE_SIZE)}")
+        parsed.append((tasks, size))
+    return parsed
+
+
+def _format_size(size: int) -> str:
+    for unit in ["G", "M", "K"]:
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+
+def _create_source():
+    """Fill the page aligned source buffer with random data, so compression and deduplication do not help."""
+    global _source
+    _source = mmap.mmap(-1, SOURCE_SIZE)
+    chunk_size = 1024 * 1024
+    for offset in range(0, SOURCE_SIZE, chunk_size):
+        _source[offset:offset + chunk_size] = os.urandom(chunk_size)
+
+
+def _get_read_buffer(size: int) -> memoryview:
+    """Return a page aligned buffer of the worker, allocated once and only grown if a larger one is needed."""
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = _buffers.buffer = mmap.mmap(-1, max(size, mmap.PAGESIZE))
+    return memoryview(buffer)[:size]
+
+
+def run_task(file_name: str, offset: int, size: int) -> Tuple[int, int]:
+    """
+    Write `size` bytes of the source at `offset` to a new file with O_SYNC and fsync, read it back and delete it,
+    like a task of test_io.sh. Returns the latency of the write and the read in nanoseconds.
+    """
+    direct = os.O_DIRECT if _direct else 0
+    data = memoryview(_source)[offset:offset + size]
+    if len(data) != size:
+        raise Exception(f"The source has no {size} bytes at offset {offset}")
+
+    try:
+        start = time.perf_counter_ns()
+        fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_SYNC | direct, 0o600)
+        try:
+            written = 0
+            while written < size:
+                num_written = os.write(fd, data[written:])
+                if num_written == 0:
+                    raise Exception(f"Could not write more than {written} of {size} bytes to {file_name}")
+                written += num_written
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        write_ns = time.perf_counter_ns() - start
+
+        buffer = _get_read_buffer(size)
+        start = time.perf_counter_ns()
+        fd = os.open(file_name, os.O_RDONLY | direct)
+        try:
+            read = 0
+            while read < size:
+                num_read = os.readv(fd, [buffer[read:]])
+                if num_read == 0:
+                    raise Exception(f"{file_name} is shorter than {size} bytes")
+                read += num_read
+        finally:
+            os.close(fd)
+        read_ns = time.perf_counter_ns() - start
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(file_name)
+    return write_ns, read_ns
+
+
+def _start_worker(_: int) -> int:
+    return os.getpid()
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+
+def _latency_stats(latencies_ns: List[int]) -> Dict[str, float]:
+    values = sorted(latency / 1e6 for latency in latencies_ns)
+    return {
+        "mean_ms": sum(values) / len(values),
+        "p50_ms": _percentile(values, 50),
+        "p99_ms": _percentile(values, 99),
+        "p999_ms": _percentile(values, 99.9),
+        "max_ms": values[-1],
+    }
+
+
+def run_scenario(executor: concurrent.futures.Executor, directory: str, tasks: int, size: int) -> Dict[str, Any]:
+    """Run `tasks` tasks of `size` bytes on the workers of `executor` and return their statistics."""
+    # Like test_io.sh, the tasks write different parts of the source
+    num_offsets = max(1, SOURCE_SIZE // size)
+    start = time.perf_counter()
+    futures = [executor.submit(run_task, os.path.join(directory, f"test_{tasks}_{size}_{i}.bin"), (i % num_offsets) * size, size)
+               for i in range(1, tasks + 1)]
+    results = [future.result() for future in futures]
+    duration = time.perf_counter() - start
+    os.sync()
+
+    return {
+        "tasks": tasks,
+        "size": size,
+        "seconds": duration,
+        # Every task does a write and a read of `size` bytes
+        "iops": 2 * tasks / duration,
+        "throughput_mb_s": 2 * tasks * size / 1e6 / duration,
+        "write": _latency_stats([write_ns for write_ns, _ in results]),
+        "read": _latency_stats([read_ns for _, read_ns in results]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the storage with the scenarios of test_io.sh and report IOPS, '
+                                                 'throughput and latency percentiles as JSON.')
+    parser.add_argument('-d', '--directory', default="/io_test",
+                        help="The directory to create the test files in, on the storage to test. Defaults to /io_test")
+    parser.add_argument('-s', '--scenarios', default=SCENARIOS, type=parse_scenarios,
+                        help=f"Comma separated TASKS@SIZE scenarios. Defaults to those of test_io.sh: {SCENARIOS}")
+    parser.add_argument('-w', '--workers', choices=["thread", "process"], default="thread",
+                        help="Run the tasks in a thread pool or a process pool. Defaults to thread")
+    parser.add_argument('-c', '--concurrency', default=0, type=int,
+                        help="The number of workers. Defaults to 0, one per task like test_io.sh for threads "
+                             "and four per core for processes")
+    parser.add_argument('--direct', action='store_true',
+                        help="Bypass the page cache with O_DIRECT. Sizes have to be multiples of the logical block size")
+    parser.add_argument('-o', '--output',
+                        help="Write the JSON report to this file instead of stdout.")
+    args = parser.parse_args()
+
+    global _direct
+    _direct = args.direct
+    if args.direct and any(size % mmap.PAGESIZE != 0 for _, size in args.scenarios):
+        parser.error(f"--direct needs sizes that are multiples of {mmap.PAGESIZE} bytes")
+    print(f"Generating {SOURCE_SIZE // 1024 // 1024} MiB of test data...", file=sys.stderr)
+    _create_source()
+    os.makedirs(args.directory, exist_ok=True)
+
+    report: Dict[str, Any] = {
+        "host": socket.gethostname(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "directory": os.path.abspath(args.directory),
+        "workers": args.workers,
+        "direct": args.direct,
+        "scenarios": [],
+    }
+    total_start = time.perf_counter()
+    for tasks, size in args.scenarios:
+        concurrency = args.concurrency or (tasks if args.workers == "thread" else min(tasks, 4 * os.cpu_count()))
+        print(f"Test {tasks} tasks @{_format_size(size)} with {concurrency} {args.workers} workers...", end="", flush=True, file=sys.stderr)
+        if args.workers == "thread":
+            executor: concurrent.futures.Executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        else:
+            # Forked workers share the source buffer and the settings with this process
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context("fork"))
+        with executor:
+            # Start the workers before the clock runs, so their startup is not measured
+            list(executor.map(_start_worker, [] if args.workers == "thread" else range(concurrency)))
+            result = run_scenario(executor, args.directory, tasks, size)
+        result["concurrency"] = concurrency
+        report["scenarios"].append(result)
+        print(f" {result['seconds']:.2f}s, {result['iops']:.0f} IOPS, {result['throughput_mb_s']:.1f} MB/s, "
+              f"write p50/p99/p999 {result['write']['p50_ms']:.2f}/{result['write']['p99_ms']:.2f}/{result['write']['p999_ms']:.2f} ms, "
+              f"read p50/p99/p999 {result['read']['p50_ms']:.2f}/{result['read']['p99_ms']:.2f}/{result['read']['p999_ms']:.2f} ms",
+              file=sys.stderr)
+    report["seconds"] = time.perf_counter() - total_start
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+from typing import List, Optional, Set, Dict, Any, Callable
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import contextlib
+
+import migrate
+
+FAKE_BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_backend")
+sys.path.insert(0, FAKE_BACKEND_DIR)
+import backend as fake_backend  # noqa: E402
+
+BENCHMARK_POOL = "bench"
+BENCHMARK_REPO_PREFIX = "/bench-repos"
+
+
+def _generate_snapshots(num_snapshots: int, interval: int, seed: int) -> List[migrate.ZfsSnapshot]:
+    """
+    Generate `num_snapshots` snapshots roughly `interval` seconds apart, ending now.
+    A few snapshots share their creation time with their predecessor to cover ties.
+    """
+    rng = random.Random(seed)
+    creation = int(time.time()) - num_snapshots * interval
+    snapshots: List[migrate.ZfsSnapshot] = []
+    for i in range(num_snapshots):
+        if rng.random() > 0.01:
+            creation += interval + rng.randint(-interval // 10, interval // 10)
+        snapshots.append(migrate.ZfsSnapshot(
+            name=f"autosnap_{i:08d}",
+            creation=creation,
+            used=rng.randint(0, 1024 * 1024),
+            logicalreferenced=rng.randint(1024 * 1024, 1024 * 1024 * 1024),
+            guid=str(rng.getrandbits(64)),
+            written=rng.randint(0, 64 * 1024 * 1024),
+        ))
+    return snapshots
+
+
+def _reference_snapshots_to_keep(snapshots: List[migrate.ZfsSnapshot], keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> Set[str]:
+    """
+    The original policy implementation of `Backuper._must_keep`, used to verify the results of the retention engine.
+    """
+    def get_year(timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).year
+
+    def get_month(timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).month
+
+    def get_week(timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).isocalendar()[1]
+
+    def is_among_n_newest(snapshots_to_consider, snapshot, n):
+        num_newer = sum(s.creation > snapshot.creation for s in snapshots_to_consider)
+        return num_newer < n
+
+    def is_weekly(snapshots, snapshot):
+        year = get_year(snapshot.creation)
+        week = get_week(snapshot.creation)
+        snapshots_in_that_week = [s for s in snapshots if get_week(s.creation) == week and get_year(s.creation) == year]
+        return is_among_n_newest(snapshots_in_that_week, snapshot, 1)
+
+    def is_monthly(snapshots, snapshot):
+        year = get_year(snapshot.creation)
+        month = get_month(snapshot.creation)
+        snapshots_in_that_month = [s for s in snapshots if get_month(s.creation) == month and get_year(s.creation) == year]
+        return is_among_n_newest(snapshots_in_that_month, snapshot, 1)
+
+    def must_keep(snapshot):
+        if keep_last_n is None and keep_weekly_n is None and keep_monthly_n is None:
+            return True
+        if keep_last_n is not None and is_among_n_newest(snapshots, snapshot, keep_last_n):
+            return True
+        if keep_weekly_n is not None and is_weekly(snapshots, snapshot):
+            weekly_snapshots = [s for s in snapshots if is_weekly(snapshots, s)]
+            if is_among_n_newest(weekly_snapshots, snapshot, keep_weekly_n):
+                return True
+        if keep_monthly_n is not None and is_monthly(snapshots, snapshot):
+            monthly_snapshots = [s for s in snapshots if is_monthly(snapshots, s)]
+            if is_among_n_newest(monthly_snapshots, snapshot, keep_monthly_n):
+                return True
+        return False
+
+    return {snapshot.name for snapshot in snapshots if must_keep(snapshot)}
+
+
+def benchmark_retention(args):
+    snapshots = _generate_snapshots(args.snapshots, args.interval, args.seed)
+    policy = (args.keep_last_n, args.keep_weekly_n, args.keep_monthly_n)
+
+    if args.verify > 0:
+        sample = snapshots[-args.verify:]
+        start = time.perf_counter()
+        expected = _reference_snapshots_to_keep(sample, *policy)
+        reference_duration = time.perf_counter() - start
+        if migrate._get_snapshots_to_keep(sample, *policy) != expected:
+            print(f"MISMATCH: retention engine differs from the reference implementation on {len(sample)} snapshots.")
+            exit(1)
+        print(f"Verified against reference implementation on {len(sample)} snapshots (reference took {reference_duration:.3f}s).")
+
+    durations = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        snapshots_to_keep = migrate._get_snapshots_to_keep(snapshots, *policy)
+        durations.append(time.perf_counter() - start)
+    print(f"Retention engine on {len(snapshots)} snapshots: keeps {len(snapshots_to_keep)}, "
+          f"best {min(durations):.3f}s, mean {sum(durations) / len(durations):.3f}s over {args.repeat} runs.")
+
+
+def _generate_fake_backend(args) -> List[str]:
+    """
+    Fill the fake backend state in FAKE_BACKEND_DIR and return the names of the generated datasets.
+    """
+    rng = random.Random(args.seed)
+    datasets: Dict[str, Dict[str, Any]] = {
+        BENCHMARK_POOL: {"creation": 0, "guid": str(rng.getrandbits(64)), "mountpoint": f"/{BENCHMARK_POOL}", "snapshots": []},
+    }
+    for i in range(args.datasets):
+        dataset_name = f"{BENCHMARK_POOL}/ds{i:04d}"
+        snapshots = [snapshot._asdict() for snapshot in _generate_snapshots(args.snapshots, args.interval, args.seed + i)]
+        for j in range(1, len(snapshots)):
+            snapshots[j]["diff"] = True
+            # A zero diff snapshot follows one without used space and has no changes to it
+            if rng.random() < args.zero_diff_ratio:
+                snapshots[j - 1]["used"] = 0
+                snapshots[j]["written"] = 0
+                snapshots[j]["diff"] = False
+        datasets[dataset_name] = {"creation": 0, "guid": str(rng.getrandbits(64)), "mountpoint": f"/{dataset_name}", "snapshots": snapshots}
+
+        repo = f"{BENCHMARK_REPO_PREFIX}/ds{i:04d}"
+        with fake_backend.locked_repo(repo) as state:
+            state["state"] = {"snapshots": []}
+            for snapshot in [snapshot for snapshot in snapshots if snapshot.get("diff", True)][:args.repo_snapshots]:
+                snapshot_id = os.urandom(32).hex()
+                state["state"]["snapshots"].append({
+                    "id": snapshot_id,
+                    "short_id": snapshot_id[:8],
+                    "time": datetime.datetime.fromtimestamp(snapshot["creation"]).astimezone().isoformat(),
+                    "tags": [f"{migrate.SNAPSHOT_TAG}{snapshot['name']}", f"{migrate.LOGICAL_REFERENCED_TAG}{snapshot['logicalreferenced']}"],
+                })
+    fake_backend.save_zfs({"datasets": datasets})
+    return [name for name in datasets if name != BENCHMARK_POOL]
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def _run_step(name: str, args, state_dir: str, step: Callable[[migrate.Backuper], Any]):
+    """
+    Run `step` with a fresh Backuper against the fake backend and print its wall time and per-phase latencies.
+    """
+    metrics_file = os.path.join(state_dir, f"metrics-{name}.jsonl")
+    backuper = migrate.Backuper(restic_repo_prefix=BENCHMARK_REPO_PREFIX, zfs_dataset_common_prefix=BENCHMARK_POOL,
+                                restic_password_file="/dev/null", dry_run=False,
+                                cache_dir=os.path.join(state_dir, "cache") if args.cache else None,
+                                diff_jobs=args.diff_jobs, metrics=migrate.MigrationMetrics(metrics_file=metrics_file))
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        step(backuper)
+    duration = time.perf_counter() - start
+
+    durations: Dict[str, List[float]] = {}
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            for line in f:
+                record = json.loads(line)
+                if record["event"] == "phase":
+                    durations.setdefault(record["phase"], []).append(record["duration"])
+    print(f"{name}: {duration:.3f}s wall time")
+    print(f"  {'phase':<16} {'count':>6} {'total':>9} {'mean':>9} {'p50':>9} {'p99':>9}")
+    for phase, values in durations.items():
+        values.sort()
+        print(f"  {phase:<16} {len(values):>6} {sum(values):>8.3f}s {sum(values) / len(values):>8.4f}s "
+              f"{_percentile(values, 0.5):>8.4f}s {_percentile(values, 0.99):>8.4f}s")
+
+
+def benchmark_backup(args):
+    with tempfile.TemporaryDirectory(prefix="benchmark-migrate-") as state_dir:
+        os.environ["FAKE_BACKEND_DIR"] = state_dir
+        os.environ["PATH"] = FAKE_BACKEND_DIR + os.pathsep + os.environ["PATH"]
+        os.environ["FAKE_ZFS_LATENCY"] = str(args.zfs_latency)
+        os.environ["FAKE_RESTIC_LATENCY"] = str(args.restic_latency)
+        os.environ["FAKE_RESTIC_THROUGHPUT"] = str(args.restic_throughput)
+        dataset_names = _generate_fake_backend(args)
+        policy = (args.keep_last_n, args.keep_weekly_n, args.keep_monthly_n)
+        print(f"Generated {len(dataset_names)} datasets with {args.snapshots} snapshots each, "
+              f"{args.zero_diff_ratio:.0%} zero diff, {args.repo_snapshots} already in restic.")
+
+        for i in range(args.next_runs):
+            _run_step(f"backup_next_snapshot_from_dataset #{i + 1}", args, state_dir,
+                      lambda backuper: backuper.backup_next_snapshot_from_dataset(dataset_names[0], *policy))
+        _run_step("backup_dataset", args, state_dir,
+                  lambda backuper: backuper.backup_datasets(dataset_names, recursive=False, jobs=args.jobs,
+                                                            keep_last_n=args.keep_last_n, keep_weekly_n=args.keep_weekly_n, keep_monthly_n=args.keep_monthly_n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for migrate.py.')
+    subparsers = parser.add_subparsers(title='benchmarks', description="The benchmark to run", required=True, dest='subparser_name')
+
+    parser_retention = subparsers.add_parser('retention', help='Benchmark the retention policy engine on synthetic snapshots')
+    parser_retention.add_argument('-n', '--snapshots', default=100000, type=int,
+                                  help="The number of synthetic snapshots. Defaults to 100000")
+    parser_retention.add_argument('--interval', default=3600, type=int,
+                                  help="The average time between two snapshots in seconds. Defaults to hourly")
+    parser_retention.add_argument('--seed', default=0, type=int,
+                                  help="The seed for generating the snapshots.")
+    parser_retention.add_argument('--repeat', default=5, type=int,
+                                  help="How often the engine is run. Defaults to 5")
+    parser_retention.add_argument('--verify', default=500, type=int,
+                                  help="Compare the results on the newest n snapshots against the original (cubic) implementation. 0 disables. Defaults to 500")
+    parser_retention.add_argument('--keep-last-n', default=48, type=int,
+                                  help="Keep the last n snapshots. Defaults to 48")
+    parser_retention.add_argument('--keep-weekly-n', default=12, type=int,
+                                  help="Keep the last n weekly snapshots. Defaults to 12")
+    parser_retention.add_argument('--keep-monthly-n', default=24, type=int,
+                                  help="Keep the last n monthly snapshots. Defaults to 24")
+
+    parser_backup = subparsers.add_parser('backup', help='Benchmark Backuper end to end against the fake zfs/restic backend')
+    parser_backup.add_argument('--datasets', default=1, type=int,
+                               help="The number of datasets. Defaults to 1")
+    parser_backup.add_argument('-n', '--snapshots', default=200, type=int,
+                               help="The number of snapshots per dataset. Defaults to 200")
+    parser_backup.add_argument('--interval', default=3600, type=int,
+                               help="The average time between two snapshots in seconds. Defaults to hourly")
+    parser_backup.add_argument('--zero-diff-ratio', default=0.3, type=float,
+                               help="The fraction of snapshots without changes to their predecessor. Defaults to 0.3")
+    parser_backup.add_argument('--repo-snapshots', default=100, type=int,
+                               help="The number of snapshots per dataset already in the restic repo. Defaults to 100")
+    parser_backup.add_argument('--zfs-latency', default=0.0, type=float,
+                               help="Simulated latency of each zfs call in seconds.")
+    parser_backup.add_argument('--restic-latency', default=0.0, type=float,
+                               help="Simulated latency of each restic call in seconds.")
+    parser_backup.add_argument('--restic-throughput', default=0.0, type=float,
+                               help="Simulated restic backup throughput in bytes per second. 0 means instant backups")
+    parser_backup.add_argument('--next-runs', default=3, type=int,
+                               help="How often backup_next_snapshot_from_dataset is run before backing up everything. Defaults to 3")
+    parser_backup.add_argument('-j', '--jobs', default=1, type=int,
+                               help="The number of datasets to backup in parallel. Defaults to 1")
+    parser_backup.add_argument('--diff-jobs', default=4, type=int,
+                               help="The number of parallel zfs diff probes. Defaults to 4")
+    parser_backup.add_argument('--cache', action='store_true',
+                               help="Use a persistent cache dir, shared between the benchmark steps.")
+    parser_backup.add_argument('--seed', default=0, type=int,
+                               help="The seed for generating the snapshots.")
+    parser_backup.add_argument('--keep-last-n', default=None, type=int,
+                               help="Keep the last n snapshots. Defaults to all")
+    parser_backup.add_argument('--keep-weekly-n', default=None, type=int,
+                               help="Keep the last n weekly snapshots. Defaults to all")
+    parser_backup.add_argument('--keep-monthly-n', default=None, type=int,
+                               help="Keep the last n monthly snapshots. Defaults to all")
+    parser_backup.add_argument('-v', '--verbose', action='store_true',
+                               help="Show the output of migrate.py.")
+
+    args = parser.parse_args()
+
+    if args.subparser_name == "retention":
+        benchmark_retention(args)
+    elif args.subparser_name == "backup":
+        benchmark_backup(args)
+
+
+if __name__ == "__main__":
+    main()
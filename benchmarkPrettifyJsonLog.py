@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+from typing import Dict, List, Any, Tuple, Optional, Callable
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+
+import prettifyJsonLog
+
+LEVELS = ["debug", "info", "info", "info", "warning", "error"]
+WORDS = ["request", "user", "session", "backup", "snapshot", "volume", "timeout", "connection", "failed", "started",
+         "finished", "retrying", "cache", "miss", "hit", "queue", "worker", "disk", "pressure", "token"]
+
+
+def _generate_entry(rng: random.Random, timestamp: float) -> Dict[str, Any]:
+    """
+    Generate a log entry shaped like the ones of our services: header columns, a few flat attributes,
+    sometimes nested ones and rarely a long stack trace.
+    """
+    entry: Dict[str, Any] = {
+        "time": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp))}.{int(timestamp * 1000) % 1000:03d}Z",
+        "level": rng.choice(LEVELS),
+        "msg": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 12))),
+        "service": rng.choice(["auth", "mail", "backup", "web"]),
+        "request_id": f"{rng.getrandbits(64):016x}",
+        "duration_ms": round(rng.random() * 1000, 3),
+    }
+    if rng.random() < 0.3:
+        entry["user"] = {"id": rng.randint(1, 100000), "name": rng.choice(WORDS), "roles": rng.sample(WORDS, 3)}
+    if rng.random() < 0.02:
+        entry["stacktrace"] = "\n".join(f"  at module{i}.function{rng.randint(0, 99)}(file{i}.py:{rng.randint(1, 999)})"
+                                        for i in range(rng.randint(10, 200)))
+    return entry
+
+
+def _generate_log(file_name: str, num_entries: int, seed: int) -> int:
+    """
+    Write `num_entries` synthetic log lines to `file_name` and return its size in bytes.
+    """
+    rng = random.Random(seed)
+    timestamp = time.time() - num_entries
+    with open(file_name, "w") as f:
+        for _ in range(num_entries):
+            timestamp += rng.random() * 2
+            f.write(json.dumps(_generate_entry(rng, timestamp)) + "\n")
+    return os.path.getsize(file_name)
+
+
+# The original implementation of prettifyJsonLog.py, used as the baseline and to verify the output of the current one.
+
+def _reference_print_string(string: str, indent: int, continued_add_indent: int = 4):
+    remaining_string = string
+    effective_indent = indent
+    while len(remaining_string) > 0:
+        data_width = term_width - effective_indent
+        string_part = remaining_string[0:data_width]
+        remaining_string = remaining_string[data_width:]
+        print(" " * effective_indent + string_part)
+        if effective_indent == indent:
+            effective_indent += continued_add_indent
+
+
+def _reference_print_header(entry: Dict[str, Any]) -> List[str]:
+    consumed_keys = []
+    header_values = []
+    for col in range(0, len(prettifyJsonLog.HEADER_COLUMNS)):
+        key, value = None, ""
+        for col_name in prettifyJsonLog.HEADER_COLUMNS[col]:
+            if col_name in entry:
+                key, value = col_name, entry[col_name]
+                break
+        header_values.append(value)
+        if key is not None:
+            consumed_keys.append(key)
+    _reference_print_string(prettifyJsonLog.HEADER_DELIMITER.join(header_values), 0)
+    return consumed_keys
+
+
+def _reference_print_attributes(attributes: Any, indent: int = 2, prefix=""):
+    if isinstance(attributes, list):
+        first = True
+        for attribute in attributes:
+            if first:
+                _reference_print_attributes(attribute, indent, prefix + "- ")
+                first = False
+            else:
+                _reference_print_attributes(attribute, indent + len(prefix), "- ")
+    elif isinstance(attributes, dict):
+        key_length = 0
+        for key in attributes:
+            k_l = len(key)
+            if k_l > key_length:
+                key_length = k_l
+        first = True
+        for key, value in attributes.items():
+            padded_key = key.ljust(key_length) + ": "
+            if first:
+                _reference_print_attributes(value, indent, prefix + padded_key)
+                first = False
+            else:
+                _reference_print_attributes(value, indent + len(prefix), padded_key)
+    else:
+        _reference_print_string(prefix + str(attributes), indent, len(prefix))
+
+
+def _reference_main(file_name: str):
+    with open(file_name) as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except:  # noqa: E722
+                print(f"Failed to load line as json: {line}")
+                continue
+            consumed_keys = _reference_print_header(data)
+            _reference_print_attributes({k: v for k, v in data.items() if k not in consumed_keys})
+
+
+def _render_reference(file_name: str, stream: io.TextIOBase):
+    with contextlib.redirect_stdout(stream):
+        _reference_main(file_name)
+
+
+def _render_current(file_name: str, stream: io.BufferedIOBase):
+    prettifyJsonLog.output = prettifyJsonLog.Output(stream)
+    prettifyJsonLog.prettify_files([file_name])
+
+
+def _time_best(repeat: int, run: Callable[[], None]) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark prettifyJsonLog.py against its original implementation.')
+    parser.add_argument('-n', '--entries', default=200000, type=int,
+                        help="The number of synthetic log entries. Defaults to 200000")
+    parser.add_argument('--width', default=120, type=int,
+                        help="The terminal width to render for. Defaults to 120")
+    parser.add_argument('--repeat', default=3, type=int,
+                        help="How often each implementation is timed, the best run is reported. Defaults to 3")
+    parser.add_argument('--seed', default=0, type=int,
+                        help="The seed of the generated log. Defaults to 0")
+    parser.add_argument('--file',
+                        help="Benchmark with this log file instead of a generated one.")
+    args = parser.parse_args()
+
+    global term_width
+    term_width = args.width
+    prettifyJsonLog.term_width = args.width
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = args.file
+        if file_name is None:
+            file_name = os.path.join(tmp_dir, "log.jsonl")
+            print(f"Generating {args.entries} log entries...")
+        size = _generate_log(file_name, args.entries, args.seed) if args.file is None else os.path.getsize(file_name)
+
+        reference_output = io.StringIO()
+        _render_reference(file_name, reference_output)
+        current_output = io.BytesIO()
+        _render_current(file_name, current_output)
+        if current_output.getvalue().decode() != reference_output.getvalue():
+            print("Output differs from the original implementation!")
+            sys.exit(1)
+        print(f"Output of {size / 1024 / 1024:.1f} MiB input matches the original implementation.")
+
+        decoders: List[Tuple[str, Optional[Callable[[bytes], Any]]]] = [("json", json.loads)]
+        if prettifyJsonLog.json_loads is not json.loads:
+            decoders.append(("orjson", prettifyJsonLog.json_loads))
+
+        results: List[Tuple[str, float]] = []
+        with open(os.devnull, "w") as devnull:
+            results.append(("original", _time_best(args.repeat, lambda: _render_reference(file_name, devnull))))
+        for decoder_name, decoder in decoders:
+            prettifyJsonLog.json_loads = decoder
+            with open(os.devnull, "wb") as devnull:
+                results.append((f"buffered ({decoder_name})", _time_best(args.repeat, lambda: _render_current(file_name, devnull))))
+
+        baseline = results[0][1]
+        print(f"{'implementation':<20} {'seconds':>8} {'MB/s':>8} {'speedup':>8}")
+        for name, duration in results:
+            print(f"{name:<20} {duration:>8.2f} {size / 1e6 / duration:>8.1f} {baseline / duration:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
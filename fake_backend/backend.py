@@ -0,0 +1,64 @@
+"""
+Shared state of the fake `zfs`, `restic`, `proot` and `sudo` commands in this directory.
+
+Prepend this directory to PATH and point FAKE_BACKEND_DIR to a state directory to run migrate.py on a plain Linux box
+without ZFS or restic. The state directory contains `zfs.json` describing the datasets and one json file per restic
+repo. Latencies can be simulated with the environment variables FAKE_ZFS_LATENCY and FAKE_RESTIC_LATENCY (seconds per
+call), FAKE_RESTIC_THROUGHPUT (bytes per second) and FAKE_RESTIC_CHANGED_RATIO (fraction of the data an incremental
+backup has to read).
+"""
+from typing import Dict, Any
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import contextlib
+
+
+def get_state_dir() -> str:
+    return os.environ["FAKE_BACKEND_DIR"]
+
+
+def sleep_latency(variable: str):
+    latency = float(os.environ.get(variable, "0"))
+    if latency > 0:
+        time.sleep(latency)
+
+
+def load_zfs() -> Dict[str, Any]:
+    with open(os.path.join(get_state_dir(), "zfs.json")) as f:
+        return json.load(f)
+
+
+def save_zfs(state: Dict[str, Any]):
+    with open(os.path.join(get_state_dir(), "zfs.json"), "w") as f:
+        json.dump(state, f)
+
+
+def get_repo_file(repo: str) -> str:
+    repo_hash = hashlib.sha256(repo.encode()).hexdigest()[:16]
+    return os.path.join(get_state_dir(), f"restic-{repo_hash}.json")
+
+
+@contextlib.contextmanager
+def locked_repo(repo: str):
+    """
+    Yield the state of `repo`, which is None if it is not initialized. Changes to the state are saved afterwards.
+    Concurrent restic processes are serialized with a lock file.
+    """
+    repo_file = get_repo_file(repo)
+    with open(repo_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = None
+        if os.path.exists(repo_file):
+            with open(repo_file) as f:
+                state = json.load(f)
+        holder = {"state": state}
+        yield holder
+        if holder["state"] is not None:
+            tmp_file = repo_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(holder["state"], f)
+            os.replace(tmp_file, repo_file)
@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
-from typing import List, Optional, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any, Set, NamedTuple, Iterable, Callable
 
 import os
+import time
+import signal
+import asyncio
+import bisect
 import argparse
-import subprocess
+import threading
 import datetime
 import json
+import hashlib
+import itertools
+import contextlib
+import concurrent.futures
 import udatetime
 
 ZFS_SNAPSHOTDIR = '.zfs/snapshot'
@@ -16,30 +24,765 @@ LOGICAL_REFERENCED_TAG = "logicalreferenced="
 DEBUG = False
 
 
-def _run(command: str, input: Optional[str] = None, void_stderr: bool = False) -> None:
-    other_args = dict()
-    if void_stderr and not DEBUG:
-        other_args["stderr"] = subprocess.DEVNULL
-    subprocess.run(command, shell=True, text=True, input=input, **other_args)
+class CommandTimeout(Exception):
+    pass
 
 
-def _eval(command: str, input: Optional[str] = None, void_stderr: bool = False) -> str:
-    other_args = dict()
-    if void_stderr and not DEBUG:
-        other_args["stderr"] = subprocess.DEVNULL
-    return subprocess.run(command, shell=True, text=True, stdout=subprocess.PIPE, input=input, **other_args).stdout
+class CommandExecutor:
+    """
+    Runs shell commands as asyncio subprocesses on an event loop in a background thread.
 
+    Commands are grouped by tool (e.g. "zfs" or "restic") and each tool has its own concurrency limit, so zfs metadata
+    gathering is not blocked by long running restic backups and vice versa. Commands are killed together with their
+    process group when they exceed the timeout of their tool or get cancelled.
+    """
 
-def _get_year(timestamp: int) -> int:
-    return datetime.datetime.fromtimestamp(timestamp).year
+    def __init__(self):
+        self.limits: Dict[str, Optional[int]] = {"zfs": 8, "restic": 4}
+        self.timeouts: Dict[str, Optional[float]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._processes: Set[asyncio.subprocess.Process] = set()
+        self._lock = threading.Lock()
 
+    def configure(self, limits: Dict[str, Optional[int]], timeouts: Dict[str, Optional[float]]):
+        """
+        Must be called before the first command is run.
+        """
+        self.limits.update(limits)
+        self.timeouts.update(timeouts)
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="command-executor", daemon=True).start()
+            return self._loop
+
+    def _get_semaphore(self, tool: str) -> Optional[asyncio.Semaphore]:
+        """
+        Must be called from the event loop.
+        """
+        limit = self.limits.get(tool)
+        if limit is None:
+            return None
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(limit)
+        return self._semaphores[tool]
+
+    @staticmethod
+    def _kill(process: asyncio.subprocess.Process):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            # Process groups stopped under pressure only handle the SIGTERM once continued
+            os.killpg(process.pid, signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+
+    async def _run_process(self, command: str, input: Optional[str], void_stderr: bool, capture: bool,
+                           on_line: Optional[Callable[[str], None]], on_start: Optional[Callable[[int], None]]) -> Tuple[int, Optional[str]]:
+        process = await asyncio.create_subprocess_shell(
+            command,
+            stdin=asyncio.subprocess.PIPE if input is not None else None,
+            stdout=asyncio.subprocess.PIPE if capture or on_line is not None else None,
+            stderr=asyncio.subprocess.DEVNULL if void_stderr and not DEBUG else None,
+            # A new session allows killing the whole pipeline on timeout or cancellation
+            start_new_session=True,
+            limit=64 * 1024 * 1024,
+        )
+        self._processes.add(process)
+        try:
+            if on_start is not None:
+                on_start(process.pid)
+            if on_line is not None:
+                if input is not None:
+                    process.stdin.write(input.encode())
+                    process.stdin.close()
+                async for line in process.stdout:
+                    on_line(line.decode(errors="replace").rstrip("\n"))
+                return await process.wait(), None
+            stdout, _ = await process.communicate(input.encode() if input is not None else None)
+            return process.returncode, stdout.decode(errors="replace") if stdout is not None else None
+        except BaseException:
+            self._kill(process)
+            await asyncio.shield(process.wait())
+            raise
+        finally:
+            self._processes.discard(process)
+
+    async def _run_limited(self, command: str, tool: str, input: Optional[str], void_stderr: bool, capture: bool,
+                           on_line: Optional[Callable[[str], None]], on_start: Optional[Callable[[int], None]]) -> Tuple[int, Optional[str]]:
+        semaphore = self._get_semaphore(tool)
+        timeout = self.timeouts.get(tool)
+        try:
+            if semaphore is None:
+                return await asyncio.wait_for(self._run_process(command, input, void_stderr, capture, on_line, on_start), timeout)
+            async with semaphore:
+                return await asyncio.wait_for(self._run_process(command, input, void_stderr, capture, on_line, on_start), timeout)
+        except asyncio.TimeoutError:
+            raise CommandTimeout(f"Command did not finish within {timeout}s: {command}")
+
+    def run(self, command: str, tool: str = "other", input: Optional[str] = None, void_stderr: bool = False,
+            capture: bool = False, on_line: Optional[Callable[[str], None]] = None,
+            on_start: Optional[Callable[[int], None]] = None) -> Tuple[int, Optional[str]]:
+        """
+        Run `command` and block until it finished. Returns the exit code and, if `capture` is set, the stdout.
+        If `on_line` is given, it is called from the event loop for every line of stdout as soon as it is available.
+        If `on_start` is given, it is called from the event loop with the id of the process group once it started.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._run_limited(command, tool, input, void_stderr, capture, on_line, on_start), self._get_loop())
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def kill_all(self):
+        """
+        Kill all running commands, e.g. when the migration is interrupted.
+        """
+        for process in list(self._processes):
+            self._kill(process)
+
+
+_executor = CommandExecutor()
+
+
+def _run(command: str, input: Optional[str] = None, void_stderr: bool = False, tool: str = "other") -> int:
+    returncode, _ = _executor.run(command, tool=tool, input=input, void_stderr=void_stderr)
+    return returncode
+
+
+def _eval(command: str, input: Optional[str] = None, void_stderr: bool = False, tool: str = "other") -> str:
+    _, stdout = _executor.run(command, tool=tool, input=input, void_stderr=void_stderr, capture=True)
+    return stdout
+
+
+def _eval_lines(command: str, on_line: Callable[[str], None], void_stderr: bool = False, tool: str = "other",
+                on_start: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Run `command` and pass each line of its output to `on_line` instead of buffering it.
+    """
+    returncode, _ = _executor.run(command, tool=tool, void_stderr=void_stderr, on_line=on_line, on_start=on_start)
+    return returncode
+
+
+class ZfsSnapshot(NamedTuple):
+    name: str
+    creation: int
+    used: int
+    logicalreferenced: int
+    guid: str
+    written: int
+
+
+class ZfsDataset(NamedTuple):
+    name: str
+    mountpoint: str
+    snapshots: List[ZfsSnapshot]
+
+
+class ZfsMetadata:
+    """
+    In-memory metadata of zfs datasets and their snapshots.
+    Whole dataset trees are fetched with a single `zfs list` call and all later lookups are served from memory.
+    """
+
+    def __init__(self):
+        self._datasets: Dict[str, ZfsDataset] = {}
+        self._recursively_loaded: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def load(self, dataset_names: Iterable[str], recursive: bool):
+        """
+        Fetch the metadata of `dataset_names`, including all datasets below them if `recursive` is set.
+        """
+        dataset_names = [name for name in dataset_names if not self._is_loaded(name, recursive)]
+        if len(dataset_names) == 0:
+            return
+        depth_flag = "-r" if recursive else "-d 1"
+        names = " ".join([f"'{name}'" for name in dataset_names])
+        mountpoints: Dict[str, str] = {}
+        snapshots: Dict[str, List[ZfsSnapshot]] = {}
+
+        def parse_line(line: str):
+            if len(line) == 0:
+                return
+            name, creation, used, logicalreferenced, guid, written, mountpoint = line.split("\t")
+            if "@" not in name:
+                mountpoints[name] = mountpoint
+                snapshots.setdefault(name, [])
+                return
+            dataset_name, snapshot_name = name.split("@", 1)
+            snapshots.setdefault(dataset_name, []).append(ZfsSnapshot(
+                name=snapshot_name,
+                creation=int(creation),
+                used=int(used),
+                logicalreferenced=int(logicalreferenced),
+                guid=guid,
+                written=int(written),
+            ))
+
+        _eval_lines(f"sudo zfs list -Hp {depth_flag} -t filesystem,snapshot -o name,creation,used,logicalreferenced,guid,written,mountpoint {names}",
+                    parse_line, tool="zfs")
+
+        with self._lock:
+            requested = set(dataset_names)
+            for dataset_name, mountpoint in mountpoints.items():
+                if not recursive and dataset_name not in requested:
+                    # Children are listed without their snapshots
+                    continue
+                dataset_snapshots = sorted(snapshots[dataset_name], key=lambda snapshot: snapshot.creation)
+                self._datasets[dataset_name] = ZfsDataset(name=dataset_name, mountpoint=mountpoint, snapshots=dataset_snapshots)
+            if recursive:
+                self._recursively_loaded.update(dataset_names)
+
+    def _is_loaded(self, dataset_name: str, recursive: bool) -> bool:
+        with self._lock:
+            if any(dataset_name == root or dataset_name.startswith(root + "/") for root in self._recursively_loaded):
+                return True
+            return not recursive and dataset_name in self._datasets
+
+    def add_dataset(self, dataset: ZfsDataset):
+        """
+        Add metadata which is already known, e.g. from a migration plan, so it is not fetched again.
+        """
+        with self._lock:
+            self._datasets[dataset.name] = dataset
+
+    def get_dataset(self, dataset_name: str) -> ZfsDataset:
+        self.load([dataset_name], recursive=False)
+        with self._lock:
+            if dataset_name not in self._datasets:
+                raise Exception(f"Dataset {dataset_name} does not exist.")
+            return self._datasets[dataset_name]
+
+    def get_dataset_names(self, dataset_prefix: str) -> List[str]:
+        """
+        Return the names of `dataset_prefix` and all filesystems below it.
+        """
+        self.load([dataset_prefix], recursive=True)
+        with self._lock:
+            return [name for name in self._datasets if name == dataset_prefix or name.startswith(dataset_prefix + "/")]
+
+
+def _format_duration(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def _escape_prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MigrationMetrics:
+    """
+    Collects phase timings and backup throughput of a migration.
+
+    Every record is appended to `metrics_file` as a JSON line, if given. If `prometheus_file` is given, it is rewritten
+    after every backup with the throughput, the remaining snapshots and an ETA per dataset, for the node exporter's
+    textfile collector.
+    """
+
+    def __init__(self, metrics_file: Optional[str] = None, prometheus_file: Optional[str] = None):
+        self.metrics_file: Optional[str] = metrics_file
+        self.prometheus_file: Optional[str] = prometheus_file
+        self._lock = threading.Lock()
+        self._phase_seconds: Dict[Tuple[str, str], float] = {}
+        self._backuped_snapshots: Dict[str, int] = {}
+        self._backuped_bytes: Dict[str, int] = {}
+        self._backup_seconds: Dict[str, float] = {}
+        self._remaining_snapshots: Dict[str, int] = {}
+        self._remaining_bytes: Dict[str, int] = {}
+
+    def _write_record(self, record: Dict[str, Any]):
+        """
+        Must be called with `_lock` held.
+        """
+        if self.metrics_file is None:
+            return
+        record = {"time": time.time(), **record}
+        with open(self.metrics_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    @contextlib.contextmanager
+    def phase(self, phase: str, **labels: str):
+        """
+        Time the enclosed block as `phase`. A "dataset" label is used to aggregate the phase timings per dataset.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self._lock:
+                key = (labels.get("dataset", ""), phase)
+                self._phase_seconds[key] = self._phase_seconds.get(key, 0.0) + duration
+                self._write_record({"event": "phase", "phase": phase, **labels, "duration": duration})
+
+    def set_remaining(self, dataset_name: str, remaining_snapshots: List[ZfsSnapshot]):
+        """
+        Set the kept snapshots of `dataset_name` which are not backuped yet.
+        """
+        with self._lock:
+            self._remaining_snapshots[dataset_name] = len(remaining_snapshots)
+            self._remaining_bytes[dataset_name] = sum(snapshot.logicalreferenced for snapshot in remaining_snapshots)
+        self._write_prometheus()
+
+    def record_backup(self, dataset_name: str, snapshot: ZfsSnapshot, duration: float, restic_snapshot_id: Optional[str]):
+        """
+        A backup without `restic_snapshot_id` failed. It is recorded with status "failed", but does not count towards
+        the throughput and the ETA.
+        """
+        with self._lock:
+            if restic_snapshot_id is None:
+                self._write_record({
+                    "event": "backup",
+                    "status": "failed",
+                    "dataset": dataset_name,
+                    "snapshot": snapshot.name,
+                    "duration": duration,
+                })
+                return
+            self._backuped_snapshots[dataset_name] = self._backuped_snapshots.get(dataset_name, 0) + 1
+            self._backuped_bytes[dataset_name] = self._backuped_bytes.get(dataset_name, 0) + snapshot.logicalreferenced
+            self._backup_seconds[dataset_name] = self._backup_seconds.get(dataset_name, 0.0) + duration
+            if dataset_name in self._remaining_snapshots:
+                self._remaining_snapshots[dataset_name] = max(0, self._remaining_snapshots[dataset_name] - 1)
+                self._remaining_bytes[dataset_name] = max(0, self._remaining_bytes[dataset_name] - snapshot.logicalreferenced)
+            self._write_record({
+                "event": "backup",
+                "status": "ok",
+                "dataset": dataset_name,
+                "snapshot": snapshot.name,
+                "restic_snapshot_id": restic_snapshot_id,
+                "duration": duration,
+                "logicalreferenced": snapshot.logicalreferenced,
+                "bytes_per_second": snapshot.logicalreferenced / duration if duration > 0 else None,
+            })
+        self._write_prometheus()
+
+    def get_throughput(self, dataset_name: str) -> Optional[float]:
+        """
+        Return the average backup throughput of `dataset_name` in logically referenced bytes per second.
+        """
+        with self._lock:
+            seconds = self._backup_seconds.get(dataset_name, 0.0)
+            if seconds <= 0:
+                return None
+            return self._backuped_bytes[dataset_name] / seconds
+
+    def get_eta(self, dataset_name: str) -> Optional[float]:
+        """
+        Return the estimated seconds until all remaining snapshots of `dataset_name` are backuped.
+        """
+        throughput = self.get_throughput(dataset_name)
+        with self._lock:
+            if throughput is None or throughput <= 0 or dataset_name not in self._remaining_bytes:
+                return None
+            return self._remaining_bytes[dataset_name] / throughput
+
+    def _write_prometheus(self):
+        if self.prometheus_file is None:
+            return
+        lines = []
+
+        def add(name: str, kind: str, description: str, values: Dict[str, float]):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for dataset_name, value in values.items():
+                lines.append(f'{name}{{dataset="{_escape_prometheus_label(dataset_name)}"}} {value}')
+
+        with self._lock:
+            datasets = set(self._backup_seconds) | set(self._remaining_snapshots)
+            throughputs = {ds: self._backuped_bytes[ds] / self._backup_seconds[ds]
+                           for ds in datasets if self._backup_seconds.get(ds, 0.0) > 0}
+            etas = {ds: self._remaining_bytes[ds] / throughputs[ds]
+                    for ds in throughputs if ds in self._remaining_bytes and throughputs[ds] > 0}
+            add("migrate_backuped_snapshots_total", "counter", "Snapshots backuped into restic.", dict(self._backuped_snapshots))
+            add("migrate_backuped_bytes_total", "counter", "Logically referenced bytes of the backuped snapshots.", dict(self._backuped_bytes))
+            add("migrate_backup_seconds_total", "counter", "Time spent in restic backup.", dict(self._backup_seconds))
+            add("migrate_backup_bytes_per_second", "gauge", "Average backup throughput in logically referenced bytes per second.", throughputs)
+            add("migrate_remaining_snapshots", "gauge", "Kept snapshots which are not backuped yet.", dict(self._remaining_snapshots))
+            add("migrate_remaining_bytes", "gauge", "Logically referenced bytes of the remaining snapshots.", dict(self._remaining_bytes))
+            add("migrate_eta_seconds", "gauge", "Estimated time until all remaining snapshots are backuped.", etas)
+            lines.append("# HELP migrate_phase_seconds_total Time spent per migration phase.")
+            lines.append("# TYPE migrate_phase_seconds_total counter")
+            for (dataset_name, phase), seconds in self._phase_seconds.items():
+                lines.append(f'migrate_phase_seconds_total{{dataset="{_escape_prometheus_label(dataset_name)}",phase="{phase}"}} {seconds}')
+
+            tmp_file = f"{self.prometheus_file}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_file, self.prometheus_file)
+
+
+class CheckPolicy(NamedTuple):
+    """
+    When and how thoroughly restic repos are checked.
+
+    `mode` is one of "full" (`restic check`), "sampled" (`restic check --read-data-subset read_data_subset`) or "none".
+    If `every_n` is None, a repo is checked after every dataset run. Otherwise it is only checked once at least
+    `every_n` snapshots were backuped into it since its last successful check.
+    """
+    mode: str = "full"
+    read_data_subset: Optional[str] = None
+    every_n: Optional[int] = None
+
+
+class PressureThrottle:
+    """
+    Adapts restic backups to the io and cpu pressure of the host, as reported by Linux PSI in /proc/pressure.
+
+    Before every snapshot the "some avg10" pressures are compared against their targets. Above its target, io pressure
+    first lowers restic's --read-concurrency to 1 and then halves its --limit-upload step by step, starting at
+    `upload_limit` KiB/s. Cpu pressure above its target lowers the compression from max to auto. Below half of the
+    targets the throttling is relaxed again. Once everything is throttled and the pressure is still too high, the next
+    snapshot waits until it drops below the targets, but at most `max_pause` seconds. The throttling changes at most
+    once per `interval` seconds, the window of avg10.
+
+    If `stop_threshold` is given, running restic process groups are stopped with SIGSTOP while a pressure exceeds it
+    and continued with SIGCONT once the pressures are below their targets again, but never stopped for more than
+    `max_stop` seconds in a row.
+    """
+
+    PRESSURE_DIR = "/proc/pressure"
+    UPLOAD_LIMIT_STEPS = 4
+    STOP_CHECK_INTERVAL = 1.0
+
+    def __init__(self, io_target: Optional[float] = None, cpu_target: Optional[float] = None, stop_threshold: Optional[float] = None,
+                 upload_limit: int = 102400, interval: float = 10.0, max_stop: float = 60.0, max_pause: float = 600.0):
+        self.targets: Dict[str, Optional[float]] = {"io": io_target, "cpu": cpu_target}
+        self.stop_threshold: Optional[float] = stop_threshold
+        self.upload_limit: int = upload_limit
+        self.interval: float = interval
+        self.max_stop: float = max_stop
+        self.max_pause: float = max_pause
+        self.available: bool = all(os.path.exists(os.path.join(self.PRESSURE_DIR, resource)) for resource in self.targets)
+        if not self.available:
+            print(f"Pressure stall information is not available in {self.PRESSURE_DIR}, restic is not throttled.")
+        self._lock = threading.Lock()
+        self._levels: Dict[str, int] = {"io": 0, "cpu": 0}
+        self._max_levels: Dict[str, int] = {"io": 1 + self.UPLOAD_LIMIT_STEPS, "cpu": 1}
+        self._last_update: Optional[float] = None
+        self._process_groups: Set[int] = set()
+        self._stopped_since: Optional[float] = None
+        self._resumed_at: float = 0.0
+        self._monitor: Optional[threading.Thread] = None
+
+    def _read_pressure(self, resource: str) -> Optional[float]:
+        """
+        Return the "some avg10" pressure of `resource` in percent or None if it can not be read.
+        """
+        try:
+            with open(os.path.join(self.PRESSURE_DIR, resource)) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) > 0 and fields[0] == "some":
+                        for field in fields[1:]:
+                            key, _, value = field.partition("=")
+                            if key == "avg10":
+                                return float(value)
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _read_pressures(self) -> Dict[str, float]:
+        pressures = {}
+        for resource in self.targets:
+            pressure = self._read_pressure(resource)
+            if pressure is not None:
+                pressures[resource] = pressure
+        return pressures
+
+    def _is_below_targets(self, pressures: Dict[str, float]) -> bool:
+        """
+        Resources without target must be below half of the stop threshold, so restic is not continued right away.
+        """
+        for resource, pressure in pressures.items():
+            target = self.targets[resource]
+            if target is None:
+                target = self.stop_threshold / 2 if self.stop_threshold is not None else None
+            if target is not None and pressure >= target:
+                return False
+        return True
+
+    def _update(self):
+        """
+        Must be called with `_lock` held.
+        """
+        now = time.monotonic()
+        if not self.available or (self._last_update is not None and now - self._last_update < self.interval):
+            return
+        self._last_update = now
+        pressures = self._read_pressures()
+        for resource, pressure in pressures.items():
+            target = self.targets[resource]
+            if target is None:
+                continue
+            level = self._levels[resource]
+            if pressure > target and level < self._max_levels[resource]:
+                level += 1
+            elif pressure < target / 2 and level > 0:
+                level -= 1
+            if level != self._levels[resource]:
+                print(f"{resource} pressure is {pressure:.1f}% with a target of {target:.1f}%, "
+                      f"{'increasing' if level > self._levels[resource] else 'decreasing'} the throttling of restic to level {level}.")
+                self._levels[resource] = level
+
+    def get_restic_flags(self) -> List[str]:
+        """
+        Return the compression and limit flags for the next `restic backup`.
+        """
+        with self._lock:
+            self._update()
+            io_level, cpu_level = self._levels["io"], self._levels["cpu"]
+        flags = ["--compression", "max" if cpu_level == 0 else "auto"]
+        if io_level >= 1:
+            flags += ["--read-concurrency", "1"]
+        if io_level >= 2:
+            flags += ["--limit-upload", str(max(1, self.upload_limit >> (io_level - 2)))]
+        return flags
+
+    def needs_pause(self) -> bool:
+        """
+        Whether all resources with a target are throttled as far as possible and one is still above its target.
+        """
+        throttled = [resource for resource, target in self.targets.items() if target is not None]
+        with self._lock:
+            self._update()
+            if len(throttled) == 0 or any(self._levels[resource] < self._max_levels[resource] for resource in throttled):
+                return False
+        return self.available and not self._is_below_targets(self._read_pressures())
+
+    def pause(self, cancelled: threading.Event):
+        """
+        Wait until the pressures are below their targets, but at most `max_pause` seconds. Afterwards the next snapshot
+        continues at the most throttled level, so a host which stays loaded does not stall the migration.
+        """
+        print(f"Pressure is above its target although restic is throttled, pausing before the next snapshot for up to {_format_duration(self.max_pause)}.")
+        start = time.monotonic()
+        last_message = start
+        while not cancelled.wait(self.interval):
+            pressures = self._read_pressures()
+            if self._is_below_targets(pressures):
+                return
+            now = time.monotonic()
+            if now - start >= self.max_pause:
+                print(f"Pressure stayed above its target for {_format_duration(now - start)}, continuing at the most throttled level.")
+                return
+            if now - last_message >= 60:
+                last_message = now
+                print(f"Still pausing after {_format_duration(now - start)}, pressure is "
+                      f"{', '.join(f'{resource} {pressure:.1f}%' for resource, pressure in pressures.items())}.")
+        raise Exception("Migration was cancelled.")
+
+    def _signal_process_groups(self, signal_number: int):
+        """
+        Must be called with `_lock` held.
+        """
+        for process_group in self._process_groups:
+            try:
+                os.killpg(process_group, signal_number)
+            except ProcessLookupError:
+                pass
+
+    def _monitor_pressure(self):
+        while True:
+            time.sleep(self.STOP_CHECK_INTERVAL)
+            pressures = self._read_pressures()
+            now = time.monotonic()
+            with self._lock:
+                if self._stopped_since is None:
+                    may_stop = len(self._process_groups) > 0 and now - self._resumed_at >= self.interval
+                    above_threshold = any(pressure > self.stop_threshold for pressure in pressures.values())
+                    if may_stop and above_threshold:
+                        print(f"Pressure of {', '.join(f'{resource} {pressure:.1f}%' for resource, pressure in pressures.items())} "
+                              f"exceeds {self.stop_threshold:.1f}%, stopping {len(self._process_groups)} restic processes.")
+                        self._signal_process_groups(signal.SIGSTOP)
+                        self._stopped_since = now
+                elif self._is_below_targets(pressures) or now - self._stopped_since >= self.max_stop:
+                    print(f"Continuing restic processes after {now - self._stopped_since:.0f}s.")
+                    self._signal_process_groups(signal.SIGCONT)
+                    self._stopped_since = None
+                    self._resumed_at = now
+
+    @contextlib.contextmanager
+    def watch(self):
+        """
+        Yield an `on_start` callback for commands, whose process groups may be stopped under pressure while the block runs.
+        """
+        process_groups: List[int] = []
+
+        def on_start(process_group: int):
+            if self.stop_threshold is None or not self.available:
+                return
+            with self._lock:
+                process_groups.append(process_group)
+                self._process_groups.add(process_group)
+                if self._stopped_since is not None:
+                    self._signal_process_groups(signal.SIGSTOP)
+                if self._monitor is None:
+                    self._monitor = threading.Thread(target=self._monitor_pressure, name="pressure-monitor", daemon=True)
+                    self._monitor.start()
+
+        try:
+            yield on_start
+        finally:
+            with self._lock:
+                for process_group in process_groups:
+                    self._process_groups.discard(process_group)
+
+
+class MigrationJournal:
+    """
+    Append-only journal of backuped snapshots and successful repo checks, which survives interrupted runs.
+
+    Every event is written as a JSON line and synced to disk before the migration continues. A truncated last line,
+    as left behind by a crash, is ignored when loading.
+    """
+
+    def __init__(self, journal_file: str):
+        self.journal_file: str = journal_file
+        self._lock = threading.Lock()
+        self._known_repos: Set[str] = set()
+        self._backuped_snapshots: Dict[str, Set[str]] = {}
+        self._num_unverified: Dict[str, int] = {}
+        if os.path.exists(journal_file):
+            with open(journal_file) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._apply(event)
+
+    def _apply(self, event: Dict[str, Any]):
+        repo = event["repo"]
+        self._known_repos.add(repo)
+        if event["event"] == "backup":
+            self._backuped_snapshots.setdefault(repo, set()).add(event["snapshot"])
+            self._num_unverified[repo] = self._num_unverified.get(repo, 0) + 1
+        elif event["event"] == "check":
+            self._num_unverified[repo] = 0
+
+    def _append(self, event: Dict[str, Any]):
+        event = {"time": time.time(), **event}
+        with self._lock:
+            with open(self.journal_file, "a") as f:
+                f.write(json.dumps(event) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(event)
+
+    def record_backup(self, restic_repo: str, dataset_name: str, snapshot: ZfsSnapshot, restic_snapshot_id: str):
+        self._append({
+            "event": "backup",
+            "repo": restic_repo,
+            "dataset": dataset_name,
+            "snapshot": snapshot.name,
+            "guid": snapshot.guid,
+            "creation": snapshot.creation,
+            "restic_snapshot_id": restic_snapshot_id,
+        })
+
+    def record_check(self, restic_repo: str, mode: str):
+        self._append({"event": "check", "repo": restic_repo, "mode": mode})
+
+    def is_known(self, restic_repo: str) -> bool:
+        with self._lock:
+            return restic_repo in self._known_repos
 
-def _get_month(timestamp: int) -> int:
-    return datetime.datetime.fromtimestamp(timestamp).month
+    def get_backuped_snapshot_names(self, restic_repo: str) -> Set[str]:
+        with self._lock:
+            return set(self._backuped_snapshots.get(restic_repo, set()))
 
+    def get_num_unverified(self, restic_repo: str) -> int:
+        """
+        Return the number of snapshots backuped into `restic_repo` since its last successful check.
+        """
+        with self._lock:
+            return self._num_unverified.get(restic_repo, 0)
+
+
+class ResticBackupOutput:
+    """
+    Consumes the output of `restic backup --json` line by line. Keeps the summary and prints the progress every
+    `interval` seconds, so the status messages never have to be buffered.
+    """
+
+    def __init__(self, description: str, interval: float = 60.0):
+        self.description: str = description
+        self.interval: float = interval
+        self.summary: Optional[Dict[str, Any]] = None
+        self._last_progress: float = time.monotonic()
+
+    def __call__(self, line: str):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        message_type = message.get("message_type")
+        if message_type == "summary":
+            self.summary = message
+        elif message_type == "status" and time.monotonic() - self._last_progress >= self.interval:
+            self._last_progress = time.monotonic()
+            print(f"Backup of {self.description}: {message.get('percent_done', 0):.1%} done, "
+                  f"{message.get('bytes_done', 0)} of {message.get('total_bytes', 0)} bytes.")
+
+
+def _count_newer(sorted_creations: List[float], creation: float) -> int:
+    """
+    Return the number of entries in the ascending `sorted_creations` which are newer than `creation`.
+    """
+    return len(sorted_creations) - bisect.bisect_right(sorted_creations, creation)
 
-def _get_week(timestamp: int) -> int:
-    return datetime.datetime.fromtimestamp(timestamp).isocalendar()[1]
+
+def _get_snapshots_to_keep(snapshots: List[ZfsSnapshot], keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> Set[str]:
+    """
+    Return the names of all snapshots which must be kept according to the policy.
+
+    A weekly (monthly) snapshot is the newest snapshot in its week (month). The `keep_weekly_n` (`keep_monthly_n`) newest of
+    those are kept, as are the `keep_last_n` newest snapshots. If no limit is given, all snapshots are kept.
+    All snapshots are bucketed in a single pass, so this is O(n log n) in the number of snapshots.
+    """
+    if keep_last_n is None and keep_weekly_n is None and keep_monthly_n is None:
+        return {snapshot.name for snapshot in snapshots}
+
+    weeks: List[Tuple[int, int]] = []
+    months: List[Tuple[int, int]] = []
+    newest_in_week: Dict[Tuple[int, int], float] = {}
+    newest_in_month: Dict[Tuple[int, int], float] = {}
+    for snapshot in snapshots:
+        creation = snapshot.creation
+        date = datetime.datetime.fromtimestamp(creation)
+        week = (date.year, date.isocalendar()[1])
+        month = (date.year, date.month)
+        weeks.append(week)
+        months.append(month)
+        if week not in newest_in_week or newest_in_week[week] < creation:
+            newest_in_week[week] = creation
+        if month not in newest_in_month or newest_in_month[month] < creation:
+            newest_in_month[month] = creation
+
+    # Snapshots sharing the newest creation time of their bucket are all weekly (monthly) snapshots.
+    is_weekly = [snapshot.creation == newest_in_week[week] for snapshot, week in zip(snapshots, weeks)]
+    is_monthly = [snapshot.creation == newest_in_month[month] for snapshot, month in zip(snapshots, months)]
+    all_creations = sorted(snapshot.creation for snapshot in snapshots)
+    weekly_creations = sorted(snapshot.creation for snapshot, weekly in zip(snapshots, is_weekly) if weekly)
+    monthly_creations = sorted(snapshot.creation for snapshot, monthly in zip(snapshots, is_monthly) if monthly)
+
+    snapshots_to_keep: Set[str] = set()
+    for snapshot, weekly, monthly in zip(snapshots, is_weekly, is_monthly):
+        creation = snapshot.creation
+        if keep_last_n is not None and _count_newer(all_creations, creation) < keep_last_n:
+            snapshots_to_keep.add(snapshot.name)
+        elif keep_weekly_n is not None and weekly and _count_newer(weekly_creations, creation) < keep_weekly_n:
+            snapshots_to_keep.add(snapshot.name)
+        elif keep_monthly_n is not None and monthly and _count_newer(monthly_creations, creation) < keep_monthly_n:
+            snapshots_to_keep.add(snapshot.name)
+    return snapshots_to_keep
 
 
 class Backuper:
@@ -48,12 +791,48 @@ class Backuper:
                  restic_repo_prefix: str,
                  zfs_dataset_common_prefix: str,
                  restic_password_file: str,
-                 dry_run: bool):
+                 dry_run: bool,
+                 cache_dir: Optional[str] = None,
+                 diff_jobs: int = 4,
+                 metrics: Optional[MigrationMetrics] = None,
+                 journal: Optional[MigrationJournal] = None,
+                 check_policy: CheckPolicy = CheckPolicy(),
+                 throttle: Optional[PressureThrottle] = None):
         self.restic_repo_prefix: str = restic_repo_prefix.rstrip("/")
         self.zfs_dataset_common_prefix: str = zfs_dataset_common_prefix
         self.restic_password_file: str = restic_password_file
         self.dry_run: bool = dry_run
-        self._dry_run_finished_backups: List[Dict[str, Any]] = []
+        self.cache_dir: Optional[str] = cache_dir
+        self._dry_run_ids = itertools.count()
+        self._restic_snapshot_index: Dict[str, List[Dict[str, Any]]] = {}
+        self.diff_jobs: int = diff_jobs
+        self._zfs = ZfsMetadata()
+        self.metrics: MigrationMetrics = metrics if metrics is not None else MigrationMetrics()
+        self.journal: Optional[MigrationJournal] = journal
+        self.check_policy: CheckPolicy = check_policy
+        self.throttle: Optional[PressureThrottle] = throttle
+        self._num_unverified: Dict[str, int] = {}
+        self._cancelled = threading.Event()
+        self._diff_cache: Optional[Dict[str, bool]] = None
+        self._diff_cache_lock = threading.Lock()
+        self._repo_locks: Dict[str, threading.Lock] = {}
+        self._repo_locks_lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Stop all running backups. Running commands are killed and no further snapshots are started.
+        """
+        self._cancelled.set()
+        _executor.kill_all()
+
+    def _repo_lock(self, restic_repo: str) -> threading.Lock:
+        """
+        Return the lock guarding `restic_repo`, so two workers never back up into the same repo at once.
+        """
+        with self._repo_locks_lock:
+            if restic_repo not in self._repo_locks:
+                self._repo_locks[restic_repo] = threading.Lock()
+            return self._repo_locks[restic_repo]
 
     def _restic_cmd(self, restic_repo: str, restic_command: str, flags: List[str] = []) -> str:
         initial_args = ["-r", restic_repo, "--password-file", self.restic_password_file, restic_command]
@@ -61,31 +840,111 @@ class Backuper:
         arg_string = " ".join([f"'{arg}'" for arg in args])
         return f"restic {arg_string}"
 
-    def _get_dataset_snapshots(self, dataset_name: str) -> List[Dict[str, Any]]:
-        lines = _eval(f"sudo zfs list -Hp -o name,creation,used,logicalreferenced -t snapshot '{dataset_name}'")
-        snapshots: List[Dict[str, Any]] = []
-        for line in lines.split("\n"):
-            if len(line) == 0:
-                continue
-            values = line.split("\t")
-            snapshot: Dict[str, Any] = {
-                "name": values[0].split("@")[-1],
-                "creation": int(values[1]),
-                "used": int(values[2]),
-                "logicalreferenced": int(values[3]),
-            }
-            snapshots.append(snapshot)
+    def _get_datasets(self, dataset_prefix: str) -> List[str]:
+        return self._zfs.get_dataset_names(dataset_prefix)
+
+    def _get_diff_cache_file(self) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, "zfs-diff.json")
+
+    def _get_diff_cache(self) -> Dict[str, bool]:
+        """
+        Return the cache of zfs diff probes, mapping "<parent guid>:<snapshot guid>" to whether there is a diff.
+        Must be called with `_diff_cache_lock` held.
+        """
+        if self._diff_cache is None:
+            self._diff_cache = {}
+            cache_file = self._get_diff_cache_file()
+            if cache_file is not None and os.path.exists(cache_file):
+                with open(cache_file) as f:
+                    self._diff_cache = json.load(f)
+        return self._diff_cache
+
+    def _save_diff_cache(self):
+        """
+        Must be called with `_diff_cache_lock` held.
+        """
+        cache_file = self._get_diff_cache_file()
+        if cache_file is None or self._diff_cache is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._diff_cache, f)
+        os.replace(tmp_file, cache_file)
+
+    def _has_diff(self, dataset_name: str, parent_name: str, snapshot_name: str) -> Optional[bool]:
+        """
+        Return whether there is a diff between the snapshots or None if zfs diff failed.
+        Only the first byte of the diff is read, the exit status of zfs diff is reported on a separate line.
+        """
+        output = _eval(f"exec 3>&1; {{ zfs diff {dataset_name}@{parent_name} {dataset_name}@{snapshot_name}; echo \"status $?\" >&3; }} | head -c1 | wc -c", tool="zfs")
+        num_bytes, status = None, None
+        for line in output.split("\n"):
+            if line.startswith("status "):
+                status = int(line.split(" ", 1)[1])
+            elif line.strip() != "":
+                num_bytes = int(line)
+        if num_bytes is not None and num_bytes > 0:
+            # zfs diff may be killed by SIGPIPE once the first byte was read
+            return True
+        if num_bytes == 0 and status == 0:
+            return False
+        return None
+
+    def _get_snapshot_diffs(self, dataset_name: str, pairs: List[Tuple[ZfsSnapshot, ZfsSnapshot]]) -> Dict[str, bool]:
+        """
+        Return whether there is a diff between each (parent, snapshot) pair, keyed by their guids.
+        Pairs which are not cached yet are probed with `diff_jobs` parallel `zfs diff` calls. Failed probes count as
+        diffs and are not cached, so they are probed again in the next run.
+        """
+        with self._diff_cache_lock:
+            diff_cache = self._get_diff_cache()
+            diffs = {}
+            pairs_to_probe = []
+            for parent, snapshot in pairs:
+                key = f"{parent.guid}:{snapshot.guid}"
+                if key in diff_cache:
+                    diffs[key] = diff_cache[key]
+                else:
+                    pairs_to_probe.append((key, parent, snapshot))
+        if len(pairs_to_probe) == 0:
+            return diffs
+
+        print(f"Probing {len(pairs_to_probe)} snapshots of {dataset_name} for zero diffs ({len(diffs)} cached).")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.diff_jobs) as executor:
+            futures = {executor.submit(self._has_diff, dataset_name, parent.name, snapshot.name): key
+                       for key, parent, snapshot in pairs_to_probe}
+            probed = {futures[future]: future.result() for future in concurrent.futures.as_completed(futures)}
+        failed = [key for key, has_diff in probed.items() if has_diff is None]
+        if len(failed) > 0:
+            print(f"zfs diff failed for {len(failed)} snapshots of {dataset_name}, treating them as changed.")
+        probed = {key: has_diff for key, has_diff in probed.items() if has_diff is not None}
+        diffs.update(probed)
+        diffs.update({key: True for key in failed})
+
+        with self._diff_cache_lock:
+            self._get_diff_cache().update(probed)
+            self._save_diff_cache()
+        return diffs
+
+    def _get_dataset_snapshots(self, dataset_name: str) -> List[ZfsSnapshot]:
+        with self.metrics.phase("zfs_list", dataset=dataset_name):
+            snapshots = self._zfs.get_dataset(dataset_name).snapshots
+        # A snapshot following one without used space may be identical to it, which only zfs diff can tell.
+        pairs = [(snapshots[i - 1], snapshot) for i, snapshot in enumerate(snapshots) if i > 0 and snapshots[i - 1].used == 0]
+        with self.metrics.phase("zfs_diff", dataset=dataset_name):
+            diffs = self._get_snapshot_diffs(dataset_name, pairs)
         snapshots_with_size = []
         for i, snapshot in enumerate(snapshots):
-            if i == 0 or snapshots[i - 1]["used"] != 0:
+            if i == 0 or snapshots[i - 1].used != 0:
                 snapshots_with_size.append(snapshot)
                 continue
-            parent_name = snapshots[i - 1]["name"]
-            snapshot_name = snapshot["name"]
-            if "0\n" != _eval(f"zfs diff {dataset_name}@{parent_name} {dataset_name}@{snapshot_name} 2>&1 | head -c1 | wc -c"):
+            if diffs[f"{snapshots[i - 1].guid}:{snapshot.guid}"]:
                 snapshots_with_size.append(snapshot)
                 continue
-            print(F"Not considering snapshot {dataset_name}@{snapshot_name} because of zero diff.")
+            print(F"Not considering snapshot {dataset_name}@{snapshot.name} because of zero diff.")
         return snapshots_with_size
 
     def _get_snapshot_tag(self, datum: Dict[str, Any]) -> str:
@@ -96,8 +955,10 @@ class Backuper:
                 return tag[len(SNAPSHOT_TAG):]
         raise Exception("Snapshot does not have a valid snapshot tag.")
 
-    def _get_snapshots_in_restic(self, restic_repo: str) -> List[Dict[str, Any]]:
-        json_data = _eval(self._restic_cmd(restic_repo, "snapshots", ["--json"]))
+    def _query_snapshots_in_restic(self, restic_repo: str) -> List[Dict[str, Any]]:
+        returncode, json_data = _executor.run(self._restic_cmd(restic_repo, "snapshots", ["--json"]), tool="restic", capture=True)
+        if returncode != 0:
+            raise Exception(f"Listing the snapshots of restic repo {restic_repo} failed with exit code {returncode}.")
         data = json.loads(json_data)
         return [{
             "id": datum["id"],
@@ -105,6 +966,65 @@ class Backuper:
             "creation": datetime.datetime.timestamp(udatetime.from_string(datum["time"])),
         } for datum in data]
 
+    def _query_snapshot_ids_in_restic(self, restic_repo: str) -> Set[str]:
+        returncode, lines = _executor.run(self._restic_cmd(restic_repo, "list", ["snapshots"]), tool="restic", capture=True)
+        if returncode != 0:
+            raise Exception(f"Listing the snapshot ids of restic repo {restic_repo} failed with exit code {returncode}.")
+        return set(line for line in lines.split("\n") if len(line) > 0)
+
+    def _get_restic_index_file(self, restic_repo: str) -> Optional[str]:
+        if self.cache_dir is None:
+            return None
+        repo_hash = hashlib.sha256(restic_repo.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"restic-index-{repo_hash}.json")
+
+    def _load_restic_index(self, restic_repo: str) -> List[Dict[str, Any]]:
+        """
+        Load the snapshot index of `restic_repo` from the cache dir. The cached index is only used if it contains
+        exactly the snapshots listed by the cheap `restic list snapshots`, otherwise the repo is queried in full.
+        """
+        index_file = self._get_restic_index_file(restic_repo)
+        if index_file is not None and os.path.exists(index_file):
+            with open(index_file) as f:
+                cached = json.load(f)
+            cached_snapshots = cached["snapshots"] if cached.get("repo") == restic_repo else []
+            if set(s["id"] for s in cached_snapshots) == self._query_snapshot_ids_in_restic(restic_repo):
+                return cached_snapshots
+            print(f"Cached snapshot index of {restic_repo} is outdated, refreshing it.")
+        snapshots = sorted(self._query_snapshots_in_restic(restic_repo), key=lambda s: s["creation"])
+        self._save_restic_index(restic_repo, snapshots)
+        return snapshots
+
+    def _save_restic_index(self, restic_repo: str, snapshots: List[Dict[str, Any]]):
+        index_file = self._get_restic_index_file(restic_repo)
+        if index_file is None or self.dry_run:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = f"{index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"repo": restic_repo, "snapshots": snapshots}, f)
+        os.replace(tmp_file, index_file)
+
+    def _get_snapshots_in_restic(self, dataset_name: str) -> List[Dict[str, Any]]:
+        """
+        Return the snapshots in the restic repo of `dataset_name` sorted by creation time.
+        The repo is only listed on first use or after the index was invalidated.
+        """
+        restic_repo, _ = self._get_repo_name_and_path(dataset_name)
+        if restic_repo not in self._restic_snapshot_index:
+            with self.metrics.phase("restic_list", dataset=dataset_name, repo=restic_repo):
+                self._restic_snapshot_index[restic_repo] = self._load_restic_index(restic_repo)
+        return list(self._restic_snapshot_index[restic_repo])
+
+    def _add_to_restic_index(self, restic_repo: str, restic_snapshot: Dict[str, Any]):
+        snapshots = self._restic_snapshot_index.setdefault(restic_repo, [])
+        snapshots.append(restic_snapshot)
+        snapshots.sort(key=lambda s: s["creation"])
+        self._save_restic_index(restic_repo, snapshots)
+
+    def _invalidate_restic_index(self, restic_repo: str):
+        self._restic_snapshot_index.pop(restic_repo, None)
+
     def _get_repo_name_and_path(self, dataset_name) -> Tuple[str, str]:
         ds_name_without_prefix = dataset_name.removeprefix(self.zfs_dataset_common_prefix).strip("/")
         repo_name = "/".join([self.restic_repo_prefix, ds_name_without_prefix])
@@ -112,46 +1032,94 @@ class Backuper:
 
         return repo_name, path_in_restic_repo
 
+    def _is_restic_repo_initialized(self, restic_repo: str) -> bool:
+        result = _eval(self._restic_cmd(restic_repo, "cat", ["config"]), void_stderr=True, tool="restic")
+        return "chunker_polynomial" in result
+
     def _init_restic_repo(self, restic_repo):
-        result = _eval(self._restic_cmd(restic_repo, "cat", ["config"]), void_stderr=True)
-        if "chunker_polynomial" not in result:
+        if not self._is_restic_repo_initialized(restic_repo):
             print(f"Initializing restic repo {restic_repo}.")
-            _run(self._restic_cmd(restic_repo, "init"))
+            _run(self._restic_cmd(restic_repo, "init"), tool="restic")
         else:
             print(f"Restic repo {restic_repo} already initialized.")
 
     def _check_restic_repo(self, restic_repo):
+        flags = []
+        if self.check_policy.mode == "sampled":
+            flags = ["--read-data-subset", self.check_policy.read_data_subset]
         print(f"Checking restic repo {restic_repo}.")
-        _run(self._restic_cmd(restic_repo, "check"))
+        if self.dry_run:
+            print(f"Would run: {self._restic_cmd(restic_repo, 'check', flags)}")
+            return
+        if _run(self._restic_cmd(restic_repo, "check", flags), tool="restic") != 0:
+            raise Exception(f"Check of restic repo {restic_repo} failed.")
+        self._num_unverified[restic_repo] = 0
+        if self.journal is not None:
+            self.journal.record_check(restic_repo, self.check_policy.mode)
+
+    def _get_num_unverified(self, restic_repo: str) -> int:
+        if self.journal is not None:
+            return self.journal.get_num_unverified(restic_repo)
+        return self._num_unverified.get(restic_repo, 0)
+
+    def _is_check_due(self, restic_repo: str, finished: bool) -> bool:
+        """
+        Return whether `restic_repo` must be checked according to the check policy, `finished` being whether the
+        run of the dataset is over.
+        """
+        if self.check_policy.mode == "none":
+            return False
+        if self.check_policy.every_n is None:
+            return finished
+        return self._get_num_unverified(restic_repo) >= self.check_policy.every_n
+
+    def _is_finished_according_to_journal(self, restic_repo: str, snapshots_to_keep: Set[str]) -> bool:
+        if self.journal is None or not self.journal.is_known(restic_repo):
+            return False
+        if self.journal.get_num_unverified(restic_repo) > 0 and self._is_check_due(restic_repo, finished=True):
+            return False
+        return snapshots_to_keep.issubset(self.journal.get_backuped_snapshot_names(restic_repo))
 
     def _pre(self, dataset_name):
-        _run(f"zfs mount {dataset_name}")
+        _run(f"zfs mount {dataset_name}", tool="zfs")
         restic_repo, _ = self._get_repo_name_and_path(dataset_name)
         self._init_restic_repo(restic_repo)
 
-    def _post(self, dataset_name):
+    def _post(self, dataset_name, finished: bool = True):
         restic_repo, _ = self._get_repo_name_and_path(dataset_name)
-        self._check_restic_repo(restic_repo)
+        if not self._is_check_due(restic_repo, finished):
+            if finished:
+                print(f"Not checking restic repo {restic_repo}, {self._get_num_unverified(restic_repo)} snapshots were backuped since its last check.")
+            return
+        with self.metrics.phase("restic_check", dataset=dataset_name):
+            self._check_restic_repo(restic_repo)
 
-    def _backup_single_snapshot(self, dataset_name: str, snapshot: Dict[str, Any], parent_restic_snapshot_id: Optional[str]):
-        snapshot_name = snapshot["name"]
+    def _backup_single_snapshot(self, dataset_name: str, snapshot: ZfsSnapshot, parent_restic_snapshot_id: Optional[str]) -> Optional[str]:
+        """
+        Returns the id of the created restic snapshot or None if it could not be determined.
+        """
+        snapshot_name = snapshot.name
         restic_repo, path_in_restic_repo = self._get_repo_name_and_path(dataset_name)
 
-        ds_mountpoint = _eval(f"zfs get -Hp -o value mountpoint '{dataset_name}'").strip()
+        ds_mountpoint = self._zfs.get_dataset(dataset_name).mountpoint
         snapshot_path = "/".join([ds_mountpoint, ZFS_SNAPSHOTDIR, snapshot_name])
 
-        snapshot_time_readable = str(datetime.datetime.fromtimestamp(snapshot["creation"]))
+        snapshot_time_readable = str(datetime.datetime.fromtimestamp(snapshot.creation))
 
         # Use proot to "mount" coorect path. See https://github.com/restic/restic/issues/2092
         proot_command = f"proot -b '{snapshot_path}':'{path_in_restic_repo}'"
-        logical_referenced = snapshot["logicalreferenced"]
+        logical_referenced = snapshot.logicalreferenced
         tags = [f"{SNAPSHOT_TAG}{snapshot_name}",
                 f"{LOGICAL_REFERENCED_TAG}{logical_referenced}"]
         tags_with_flag = []
         for tag in tags:
             tags_with_flag.append("--tag")
             tags_with_flag.append(tag)
-        restic_backup_args = ["--ignore-ctime", "--time", snapshot_time_readable, "--compression", "max"] + tags_with_flag
+        if self.throttle is not None and not self.dry_run and self.throttle.needs_pause():
+            with self.metrics.phase("pressure_pause", dataset=dataset_name, snapshot=snapshot_name):
+                self.throttle.pause(self._cancelled)
+        throttle_flags = self.throttle.get_restic_flags() if self.throttle is not None else ["--compression", "max"]
+        restic_backup_args = ["--json", "--ignore-ctime", "--time", snapshot_time_readable] + throttle_flags + tags_with_flag
         if parent_restic_snapshot_id is not None:
             restic_backup_args += ["--parent", parent_restic_snapshot_id]
         restic_backup_args.append(path_in_restic_repo)
@@ -159,73 +1127,46 @@ class Backuper:
         print(f"Starting backup of {dataset_name}@{snapshot_name} into {restic_repo} under {path_in_restic_repo}")
         if self.dry_run:
             print(f"Would run: {proot_command} {restic_command}")
-            id = len(self._dry_run_finished_backups)
-            self._dry_run_finished_backups.append({
-                "id": f"__dry_run_{id}",
-                "name": snapshot["name"],
-                "creation": snapshot["creation"],
-            })
-        else:
-            _run(f"{proot_command} {restic_command}")
+            return f"__dry_run_{next(self._dry_run_ids)}"
+        start = time.monotonic()
+        output = ResticBackupOutput(f"{dataset_name}@{snapshot_name}")
+        with self.metrics.phase("restic_backup", dataset=dataset_name, snapshot=snapshot_name), \
+                self.throttle.watch() if self.throttle is not None else contextlib.nullcontext() as on_start:
+            returncode = _eval_lines(f"{proot_command} {restic_command}", output, tool="restic", on_start=on_start)
+        duration = time.monotonic() - start
+        summary = output.summary
+        restic_snapshot_id = summary.get("snapshot_id") if summary is not None else None
+        self.metrics.record_backup(dataset_name, snapshot, duration, restic_snapshot_id)
+        if restic_snapshot_id is None:
+            print(f"Backup of {dataset_name}@{snapshot_name} did not report a restic snapshot, restic exited with {returncode}.")
+            return None
+        throughput = logical_referenced / duration if duration > 0 else 0
+        print(f"Finished backup of {dataset_name}@{snapshot_name} as restic snapshot {restic_snapshot_id} in {_format_duration(duration)} "
+              f"({throughput / 1024 / 1024:.1f} MiB/s): {summary.get('files_new', 0)} new and {summary.get('files_changed', 0)} changed files, "
+              f"{summary.get('data_added', 0)} bytes added.")
+        return restic_snapshot_id
 
     def backup_single_snapshot(self, dataset_name: str, snapshot_name: str, parent_restic_snapshot_id: Optional[str]):
         self._pre(dataset_name)
         snapshots = self._get_dataset_snapshots(dataset_name)
-        snapshots_with_correct_name = [snapshot for snapshot in snapshots if snapshot["name"] == snapshot_name]
+        snapshots_with_correct_name = [snapshot for snapshot in snapshots if snapshot.name == snapshot_name]
         if len(snapshots_with_correct_name) < 1:
             raise Exception("Did not find a snapshot with that name")
         self._backup_single_snapshot(dataset_name, snapshots_with_correct_name[0], parent_restic_snapshot_id)
         self._post(dataset_name)
 
-    def _is_among_n_newest(self, snapshots_to_consider: List[Dict[str, Any]], snapshot: Dict[str, Any], n: int):
-        num_newer = sum(s["creation"] > snapshot["creation"] for s in snapshots_to_consider)
-        return num_newer < n
-
-    def _is_weekly(self, snapshots: List[Dict[str, Any]], snapshot: Dict[str, Any]) -> bool:
-        year = _get_year(snapshot["creation"])
-        week = _get_week(snapshot["creation"])
-        snapshots_in_that_week = [snapshot for snapshot in snapshots if _get_week(snapshot["creation"]) == week and _get_year(snapshot["creation"]) == year]
-        return self._is_among_n_newest(snapshots_in_that_week, snapshot, 1)
-
-    def _is_monthly(self, snapshots: List[Dict[str, Any]], snapshot: Dict[str, Any]) -> bool:
-        year = _get_year(snapshot["creation"])
-        month = _get_month(snapshot["creation"])
-        snapshots_in_that_month = [snapshot for snapshot in snapshots if _get_month(snapshot["creation"]) == month and _get_year(snapshot["creation"]) == year]
-        return self._is_among_n_newest(snapshots_in_that_month, snapshot, 1)
-
-    def _must_keep(self, snapshots: List[Dict[str, Any]], snapshot: Dict[str, Any], keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> bool:
-        if keep_last_n is None and keep_weekly_n is None and keep_monthly_n is None:
-            return True
-
-        # Last n
-        if keep_last_n is not None and self._is_among_n_newest(snapshots, snapshot, keep_last_n):
-            return True
-
-        # Weekly n
-        if keep_weekly_n is not None and self._is_weekly(snapshots, snapshot):
-            # This is a weekly snapshot
-            weekly_snapshots = [snapshot for snapshot in snapshots if self._is_weekly(snapshots, snapshot)]
-            if self._is_among_n_newest(weekly_snapshots, snapshot, keep_weekly_n):
-                return True
-
-        # Monthly n
-        if keep_monthly_n is not None and self._is_monthly(snapshots, snapshot):
-            # This is a monthly snapshot
-            monthly_snapshots = [snapshot for snapshot in snapshots if self._is_monthly(snapshots, snapshot)]
-            if self._is_among_n_newest(monthly_snapshots, snapshot, keep_monthly_n):
-                return True
-
-        return False
-
-    def _find_next_snapshot(self, dataset_name: str, snapshots: List[Dict[str, Any]], snapshots_in_restic: List[Dict[str, Any]],
-                            keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> Optional[Dict[str, Any]]:
+    def _find_next_snapshot(self, dataset_name: str, snapshots: List[ZfsSnapshot], snapshots_in_restic: List[Dict[str, Any]],
+                            snapshots_to_keep: Set[str]) -> Optional[ZfsSnapshot]:
         """
         `snapshots` must be sorted by creation time.
         """
         snapshot_names_in_restic = set([s["name"] for s in snapshots_in_restic])
+        if self.journal is not None:
+            restic_repo, _ = self._get_repo_name_and_path(dataset_name)
+            snapshot_names_in_restic |= self.journal.get_backuped_snapshot_names(restic_repo)
         for snapshot in snapshots:
-            snapshot_name = snapshot["name"]
-            if not self._must_keep(snapshots, snapshot, keep_last_n, keep_weekly_n, keep_monthly_n):
+            snapshot_name = snapshot.name
+            if snapshot_name not in snapshots_to_keep:
                 print(F"Skipping snapshot {dataset_name}@{snapshot_name} because it does not need to be kept according to the policy.")
                 continue
             if snapshot_name in snapshot_names_in_restic:
@@ -234,44 +1175,304 @@ class Backuper:
             return snapshot
         return None
 
-    def _backup_next_snapshot_from_dataset(self, dataset_name, snapshots: List[Dict[str, Any]], keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> Optional[Dict[str, Any]]:
+    def _backup_next_snapshot_from_dataset(self, dataset_name, snapshots: List[ZfsSnapshot], snapshots_to_keep: Set[str]) -> Optional[ZfsSnapshot]:
         restic_repo, _ = self._get_repo_name_and_path(dataset_name)
 
-        snapshots_in_restic = self._get_snapshots_in_restic(restic_repo)
-        if self.dry_run:
-            snapshots_in_restic += self._dry_run_finished_backups
+        snapshots_in_restic = self._get_snapshots_in_restic(dataset_name)
 
-        snapshot = self._find_next_snapshot(dataset_name, snapshots, snapshots_in_restic, keep_last_n, keep_weekly_n, keep_monthly_n)
+        snapshot = self._find_next_snapshot(dataset_name, snapshots, snapshots_in_restic, snapshots_to_keep)
+        snapshot_names_in_restic = set(s["name"] for s in snapshots_in_restic)
+        self.metrics.set_remaining(dataset_name, [s for s in snapshots if s.name in snapshots_to_keep and s.name not in snapshot_names_in_restic])
         if snapshot is None:
             print(f"No further snapshots need to backuped for {dataset_name}.")
             return None
 
         parent_restic_snapshot_id = None
-        ancestors_in_restic = [ancestor for ancestor in snapshots_in_restic if ancestor["creation"] < snapshot["creation"]]
+        ancestors_in_restic = [ancestor for ancestor in snapshots_in_restic if ancestor["creation"] < snapshot.creation]
         if len(ancestors_in_restic) > 0:
             parent_restic_snapshot_id = ancestors_in_restic[-1]["id"]
-        self._backup_single_snapshot(dataset_name, snapshot, parent_restic_snapshot_id)
+        self._backup_and_record_snapshot(dataset_name, snapshot, parent_restic_snapshot_id)
         return snapshot
 
+    def _backup_and_record_snapshot(self, dataset_name: str, snapshot: ZfsSnapshot, parent_restic_snapshot_id: Optional[str]) -> Optional[str]:
+        """
+        Backup `snapshot` and record it in the restic snapshot index and the journal.
+        Returns the id of the created restic snapshot or None if it could not be determined.
+        """
+        restic_repo, _ = self._get_repo_name_and_path(dataset_name)
+        restic_snapshot_id = self._backup_single_snapshot(dataset_name, snapshot, parent_restic_snapshot_id)
+        if restic_snapshot_id is None:
+            print(f"Could not determine the restic snapshot of {dataset_name}@{snapshot.name}, the snapshot index of {restic_repo} will be refreshed.")
+            self._invalidate_restic_index(restic_repo)
+        else:
+            self._add_to_restic_index(restic_repo, {
+                "id": restic_snapshot_id,
+                "name": snapshot.name,
+                "creation": snapshot.creation,
+            })
+            if not self.dry_run:
+                self._num_unverified[restic_repo] = self._num_unverified.get(restic_repo, 0) + 1
+                if self.journal is not None:
+                    self.journal.record_backup(restic_repo, dataset_name, snapshot, restic_snapshot_id)
+        return restic_snapshot_id
+
     def backup_next_snapshot_from_dataset(self, dataset_name, keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]):
         self._pre(dataset_name)
         snapshots = self._get_dataset_snapshots(dataset_name)
-        self._backup_next_snapshot_from_dataset(dataset_name, snapshots, keep_last_n, keep_weekly_n, keep_monthly_n)
+        snapshots_to_keep = _get_snapshots_to_keep(snapshots, keep_last_n, keep_weekly_n, keep_monthly_n)
+        self._backup_next_snapshot_from_dataset(dataset_name, snapshots, snapshots_to_keep)
         self._post(dataset_name)
 
-    def _backup_dataset(self, dataset_name: str, keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]):
-        snapshots = self._get_dataset_snapshots(dataset_name)
+    def _backup_dataset(self, dataset_name: str, snapshots: List[ZfsSnapshot], snapshots_to_keep: Set[str]) -> int:
+        """
+        Returns the number of snapshots which were backuped.
+        """
+        num_backuped = 0
         while True:
-            added_snapshot = self._backup_next_snapshot_from_dataset(dataset_name, snapshots, keep_last_n, keep_weekly_n, keep_monthly_n)
+            if self._cancelled.is_set():
+                raise Exception("Migration was cancelled.")
+            added_snapshot = self._backup_next_snapshot_from_dataset(dataset_name, snapshots, snapshots_to_keep)
             if added_snapshot is None:
                 break
+            num_backuped += 1
+            eta = self.metrics.get_eta(dataset_name)
+            if eta is not None:
+                print(f"Estimated time until {dataset_name} is finished: {_format_duration(eta)}")
             index = snapshots.index(added_snapshot)
             snapshots = snapshots[index + 1:]
+            self._post(dataset_name, finished=False)
+        return num_backuped
 
-    def backup_dataset(self, dataset_name: str, keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]):
-        self._pre(dataset_name)
-        self._backup_dataset(dataset_name, keep_last_n, keep_weekly_n, keep_monthly_n)
-        self._post(dataset_name)
+    def backup_dataset(self, dataset_name: str, keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> int:
+        restic_repo, _ = self._get_repo_name_and_path(dataset_name)
+        with self._repo_lock(restic_repo):
+            snapshots = self._get_dataset_snapshots(dataset_name)
+            # The policy only depends on the newer snapshots, so it can be evaluated once for the whole dataset.
+            snapshots_to_keep = _get_snapshots_to_keep(snapshots, keep_last_n, keep_weekly_n, keep_monthly_n)
+            if self._is_finished_according_to_journal(restic_repo, snapshots_to_keep):
+                print(f"All snapshots of {dataset_name} which must be kept are backuped and verified according to the journal.")
+                return 0
+            self._pre(dataset_name)
+            num_backuped = self._backup_dataset(dataset_name, snapshots, snapshots_to_keep)
+            self._post(dataset_name)
+        return num_backuped
+
+    def _resolve_dataset_names(self, dataset_names: List[str], recursive: bool) -> List[str]:
+        """
+        Fetch the metadata of all `dataset_names` with a single zfs call and return the datasets to work on.
+        If `recursive` is set, `dataset_names` are prefixes and all filesystems below them are returned.
+        """
+        with self.metrics.phase("zfs_list"):
+            self._zfs.load(dataset_names, recursive=recursive)
+        if recursive:
+            dataset_names = [dataset for prefix in dataset_names for dataset in self._get_datasets(prefix)]
+        # Remove duplicates but keep the order
+        return list(dict.fromkeys(dataset_names))
+
+    def _for_datasets_in_parallel(self, dataset_names: List[str], jobs: int, backup: Callable[[str], int]) -> bool:
+        """
+        Run `backup` for every dataset using up to `jobs` datasets in parallel and print a summary.
+        `backup` returns the number of backuped snapshots. Returns whether all datasets were backuped successfully.
+        """
+        print(f"Backing up {len(dataset_names)} datasets with {jobs} parallel jobs.")
+
+        def timed_backup(dataset_name: str) -> Tuple[int, float]:
+            start = time.monotonic()
+            num_backuped = backup(dataset_name)
+            return num_backuped, time.monotonic() - start
+
+        start = time.monotonic()
+        succeeded: Dict[str, Tuple[int, float]] = {}
+        failed: Dict[str, str] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(timed_backup, dataset_name): dataset_name for dataset_name in dataset_names}
+            try:
+                for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                    dataset_name = futures[future]
+                    progress = f"[{i + 1}/{len(dataset_names)}]"
+                    try:
+                        num_backuped, duration = future.result()
+                    except Exception as e:
+                        failed[dataset_name] = repr(e)
+                        print(f"{progress} Backup of {dataset_name} failed: {e!r}")
+                        continue
+                    succeeded[dataset_name] = (num_backuped, duration)
+                    print(f"{progress} Backup of {dataset_name} finished: {num_backuped} snapshots in {duration:.1f}s.")
+            except KeyboardInterrupt:
+                print("Interrupted, cancelling all backups.")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.cancel()
+                raise
+
+        print()
+        print(f"Summary after {time.monotonic() - start:.1f}s:")
+        for dataset_name in dataset_names:
+            if dataset_name in succeeded:
+                num_backuped, duration = succeeded[dataset_name]
+                print(f"  OK     {dataset_name}: {num_backuped} snapshots in {duration:.1f}s")
+            else:
+                print(f"  FAILED {dataset_name}: {failed[dataset_name]}")
+        total_snapshots = sum(num_backuped for num_backuped, _ in succeeded.values())
+        print(f"{len(succeeded)} datasets succeeded ({total_snapshots} snapshots), {len(failed)} datasets failed.")
+        return len(failed) == 0
+
+    def backup_datasets(self, dataset_names: List[str], recursive: bool, jobs: int,
+                        keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> bool:
+        """
+        Backup all snapshots of multiple datasets using up to `jobs` datasets in parallel.
+        If `recursive` is set, `dataset_names` are prefixes and all filesystems below them are backuped.
+        Returns whether all datasets were backuped successfully.
+        """
+        dataset_names = self._resolve_dataset_names(dataset_names, recursive)
+        return self._for_datasets_in_parallel(dataset_names, jobs,
+                                              lambda dataset_name: self.backup_dataset(dataset_name, keep_last_n, keep_weekly_n, keep_monthly_n))
+
+    def _plan_dataset(self, dataset_name: str, keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> Dict[str, Any]:
+        """
+        Compute the ordered list of snapshots of `dataset_name` which still have to be backuped, with the restic parent
+        of each and an estimate of the bytes restic has to read for it.
+        """
+        restic_repo, path_in_restic_repo = self._get_repo_name_and_path(dataset_name)
+        dataset = self._zfs.get_dataset(dataset_name)
+        snapshots = self._get_dataset_snapshots(dataset_name)
+        snapshots_to_keep = _get_snapshots_to_keep(snapshots, keep_last_n, keep_weekly_n, keep_monthly_n)
+        # Before the first migration of a dataset its repo does not exist yet, so all its snapshots are planned
+        snapshots_in_restic = self._get_snapshots_in_restic(dataset_name) if self._is_restic_repo_initialized(restic_repo) else []
+        snapshot_names_in_restic = set(s["name"] for s in snapshots_in_restic)
+        if self.journal is not None:
+            snapshot_names_in_restic |= self.journal.get_backuped_snapshot_names(restic_repo)
+
+        # The data written since the parent is estimated with the written property of all snapshots in between
+        positions = {snapshot.name: i for i, snapshot in enumerate(dataset.snapshots)}
+        written_until = list(itertools.accumulate((snapshot.written for snapshot in dataset.snapshots), initial=0))
+
+        # Like in _backup_next_snapshot_from_dataset the parent is the newest older snapshot in restic, which
+        # includes the snapshots planned before. As the snapshots are walked in order of creation, the restic
+        # snapshots become parents in order of creation as well and a single pass finds all parents.
+        restic_parents = sorted(((s["creation"], s["name"], {"restic_snapshot_id": s["id"]}) for s in snapshots_in_restic),
+                                key=lambda parent: parent[0])
+        next_restic_parent = 0
+        parent: Optional[Tuple[float, str, Dict[str, str]]] = None
+        last_planned: Optional[Tuple[float, str, Dict[str, str]]] = None
+        planned_snapshots = []
+        for snapshot in snapshots:
+            while next_restic_parent < len(restic_parents) and restic_parents[next_restic_parent][0] < snapshot.creation:
+                if parent is None or restic_parents[next_restic_parent][0] > parent[0]:
+                    parent = restic_parents[next_restic_parent]
+                next_restic_parent += 1
+            if last_planned is not None and last_planned[0] < snapshot.creation:
+                if parent is None or last_planned[0] > parent[0]:
+                    parent = last_planned
+                last_planned = None
+            if snapshot.name not in snapshots_to_keep or snapshot.name in snapshot_names_in_restic:
+                continue
+            if parent is not None and parent[1] in positions and positions[parent[1]] < positions[snapshot.name]:
+                estimated_bytes = written_until[positions[snapshot.name] + 1] - written_until[positions[parent[1]] + 1]
+            else:
+                estimated_bytes = snapshot.logicalreferenced
+            planned_snapshots.append({
+                **snapshot._asdict(),
+                "parent": parent[2] if parent is not None else None,
+                "estimated_bytes": estimated_bytes,
+            })
+            # Of planned snapshots created at the same time, the first one stays the parent
+            if last_planned is None:
+                last_planned = (snapshot.creation, snapshot.name, {"planned": snapshot.name})
+        return {
+            "dataset": dataset_name,
+            "mountpoint": dataset.mountpoint,
+            "restic_repo": restic_repo,
+            "path_in_restic_repo": path_in_restic_repo,
+            "snapshots": planned_snapshots,
+        }
+
+    def plan(self, dataset_names: List[str], recursive: bool, jobs: int,
+             keep_last_n: Optional[int], keep_weekly_n: Optional[int], keep_monthly_n: Optional[int]) -> Dict[str, Any]:
+        """
+        Compute the complete migration plan of `dataset_names` in one pass, see `_plan_dataset`.
+        """
+        dataset_names = self._resolve_dataset_names(dataset_names, recursive)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            dataset_plans = list(executor.map(lambda dataset_name: self._plan_dataset(dataset_name, keep_last_n, keep_weekly_n, keep_monthly_n),
+                                              dataset_names))
+        return {
+            "version": 1,
+            "created": time.time(),
+            "restic_repo_prefix": self.restic_repo_prefix,
+            "zfs_dataset_common_prefix": self.zfs_dataset_common_prefix,
+            "policy": {"keep_last_n": keep_last_n, "keep_weekly_n": keep_weekly_n, "keep_monthly_n": keep_monthly_n},
+            "datasets": dataset_plans,
+        }
+
+    def _execute_dataset_plan(self, dataset_plan: Dict[str, Any]) -> int:
+        """
+        Backup the snapshots of a dataset plan in order. Returns the number of snapshots which were backuped.
+        """
+        dataset_name = dataset_plan["dataset"]
+        restic_repo, _ = self._get_repo_name_and_path(dataset_name)
+        snapshots = [ZfsSnapshot(**{field: planned[field] for field in ZfsSnapshot._fields}) for planned in dataset_plan["snapshots"]]
+        self._zfs.add_dataset(ZfsDataset(name=dataset_name, mountpoint=dataset_plan["mountpoint"], snapshots=snapshots))
+        with self._repo_lock(restic_repo):
+            if len(snapshots) == 0:
+                print(f"No snapshots of {dataset_name} are planned.")
+                return 0
+            self._pre(dataset_name)
+            # Snapshots which were backuped by an earlier, interrupted execution are skipped
+            restic_snapshot_ids = {s["name"]: s["id"] for s in self._get_snapshots_in_restic(dataset_name)}
+            self.metrics.set_remaining(dataset_name, [snapshot for snapshot in snapshots if snapshot.name not in restic_snapshot_ids])
+            num_backuped = 0
+            for snapshot, planned in zip(snapshots, dataset_plan["snapshots"]):
+                if self._cancelled.is_set():
+                    raise Exception("Migration was cancelled.")
+                if snapshot.name in restic_snapshot_ids:
+                    print(F"Skipping snapshot {dataset_name}@{snapshot.name} because it's already migrated.")
+                    continue
+                parent = planned["parent"]
+                parent_restic_snapshot_id = None
+                if parent is not None and "restic_snapshot_id" in parent:
+                    parent_restic_snapshot_id = parent["restic_snapshot_id"]
+                elif parent is not None:
+                    parent_restic_snapshot_id = restic_snapshot_ids.get(parent["planned"])
+                    if parent_restic_snapshot_id is None:
+                        print(f"Planned parent {parent['planned']} of {dataset_name}@{snapshot.name} was not backuped, backing up without parent.")
+                restic_snapshot_id = self._backup_and_record_snapshot(dataset_name, snapshot, parent_restic_snapshot_id)
+                if restic_snapshot_id is not None:
+                    restic_snapshot_ids[snapshot.name] = restic_snapshot_id
+                num_backuped += 1
+                self._post(dataset_name, finished=False)
+            self._post(dataset_name)
+        return num_backuped
+
+    def execute_plan(self, plan: Dict[str, Any], jobs: int) -> bool:
+        """
+        Backup all snapshots of a plan created by `plan` without planning again. Returns whether all datasets succeeded.
+        """
+        if plan["restic_repo_prefix"] != self.restic_repo_prefix or plan["zfs_dataset_common_prefix"] != self.zfs_dataset_common_prefix:
+            raise Exception("The plan was created for a different restic repo prefix or zfs dataset common prefix.")
+        dataset_plans = {dataset_plan["dataset"]: dataset_plan for dataset_plan in plan["datasets"]}
+        return self._for_datasets_in_parallel(list(dataset_plans), jobs,
+                                              lambda dataset_name: self._execute_dataset_plan(dataset_plans[dataset_name]))
+
+
+def _print_plan(plan: Dict[str, Any], verbose: bool):
+    for dataset_plan in plan["datasets"]:
+        estimated_bytes = sum(planned["estimated_bytes"] for planned in dataset_plan["snapshots"])
+        print(f"{dataset_plan['dataset']}: {len(dataset_plan['snapshots'])} snapshots, about {estimated_bytes / 1024 / 1024 / 1024:.1f} GiB to read")
+        if not verbose:
+            continue
+        for planned in dataset_plan["snapshots"]:
+            parent = planned["parent"]
+            if parent is None:
+                parent_description = "no parent"
+            elif "restic_snapshot_id" in parent:
+                parent_description = f"parent restic snapshot {parent['restic_snapshot_id'][:8]}"
+            else:
+                parent_description = f"parent {parent['planned']}"
+            print(f"  {planned['name']} ({datetime.datetime.fromtimestamp(planned['creation'])}, {parent_description}, "
+                  f"about {planned['estimated_bytes'] / 1024 / 1024:.1f} MiB)")
+    num_snapshots = sum(len(dataset_plan["snapshots"]) for dataset_plan in plan["datasets"])
+    estimated_bytes = sum(planned["estimated_bytes"] for dataset_plan in plan["datasets"] for planned in dataset_plan["snapshots"])
+    print(f"Planned {num_snapshots} snapshots in {len(plan['datasets'])} datasets, about {estimated_bytes / 1024 / 1024 / 1024:.1f} GiB to read.")
 
 
 def main():
@@ -287,6 +1488,40 @@ def main():
                         help='The path to the restic password file.')
     parser.add_argument('--dry-run', required=False, action='store_true',
                         help='Perform a dryrun, do not backup anything.')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory to persist caches like the index of restic snapshots in. Defaults to in-memory caches only.')
+    parser.add_argument('--diff-jobs', default=4, type=int,
+                        help='The number of zfs diff probes for zero diff snapshots to run in parallel. Defaults to 4')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Append phase timings and per snapshot throughput as JSON lines to this file.')
+    parser.add_argument('--prometheus-file', default=None,
+                        help='Write throughput, remaining snapshots and ETA per dataset to this Prometheus textfile, e.g. for the node exporter.')
+    parser.add_argument('--zfs-jobs', default=8, type=int,
+                        help='The maximum number of zfs commands running at the same time. Defaults to 8')
+    parser.add_argument('--restic-jobs', default=4, type=int,
+                        help='The maximum number of restic commands running at the same time. Defaults to 4')
+    parser.add_argument('--zfs-timeout', default=None, type=float,
+                        help='Kill zfs commands running longer than this many seconds. Defaults to no timeout')
+    parser.add_argument('--restic-timeout', default=None, type=float,
+                        help='Kill restic commands running longer than this many seconds. Defaults to no timeout')
+    parser.add_argument('--journal', default=None,
+                        help='Journal of backuped and verified snapshots. Interrupted runs resume from it and finished datasets are skipped.')
+    parser.add_argument('--check', default="full", choices=["full", "sampled", "none"],
+                        help='How to check restic repos: "full" runs restic check, "sampled" additionally reads --check-read-data-subset of the data. Defaults to full')
+    parser.add_argument('--check-read-data-subset', default="1/20",
+                        help='The subset of the data to read for sampled checks, passed to restic check --read-data-subset. Defaults to 1/20')
+    parser.add_argument('--check-every-n', default=None, type=int,
+                        help='Only check a repo once n snapshots were backuped into it since its last check, needs --journal. Defaults to checking after every dataset')
+    parser.add_argument('--io-pressure-target', default=None, type=float,
+                        help='Throttle restic while the io pressure (some avg10 of /proc/pressure/io) is above this percentage. Defaults to no throttling')
+    parser.add_argument('--cpu-pressure-target', default=None, type=float,
+                        help='Lower the compression of restic while the cpu pressure (some avg10 of /proc/pressure/cpu) is above this percentage. Defaults to no throttling')
+    parser.add_argument('--pressure-stop', default=None, type=float,
+                        help='Stop running restic processes while the io or cpu pressure is above this percentage. Defaults to never stopping them')
+    parser.add_argument('--max-pressure-pause', default=600.0, type=float,
+                        help='Pause at most this many seconds before a snapshot while restic is fully throttled and the pressure is still too high. Defaults to 600')
+    parser.add_argument('--throttle-upload-limit', default=102400, type=int,
+                        help='The first --limit-upload of restic in KiB/s when io pressure is too high, halved while it stays too high. Defaults to 102400')
 
     subparsers = parser.add_subparsers(title='commands', description="The command to run", required=True, dest='subparser_name')
 
@@ -318,18 +1553,101 @@ def main():
     parser_single_dataset.add_argument('--keep-monthly-n', default=None, type=int,
                                        help="Keep the last n monthly snapshots. A monthly snapshot is the newest snapshot in a month. Defaults to all")
 
+    parser_multiple_datasets = subparsers.add_parser('datasets', help='Backup all snapshots of multiple datasets in parallel')
+    parser_multiple_datasets.add_argument('dataset_names', nargs='+',
+                                          help="The names of the datasets to backup.")
+    parser_multiple_datasets.add_argument('-R', '--recursive', action='store_true',
+                                          help="Treat the dataset names as prefixes and backup all filesystems below them.")
+    parser_multiple_datasets.add_argument('-j', '--jobs', default=4, type=int,
+                                          help="The number of datasets to backup in parallel. Defaults to 4")
+    parser_multiple_datasets.add_argument('--keep-last-n', default=None, type=int,
+                                          help="Keep the last n snapshots. Defaults to all")
+    parser_multiple_datasets.add_argument('--keep-weekly-n', default=None, type=int,
+                                          help="Keep the last n weekly snapshots. A weekly snapshot is the newest snapshot in a week. Defaults to all")
+    parser_multiple_datasets.add_argument('--keep-monthly-n', default=None, type=int,
+                                          help="Keep the last n monthly snapshots. A monthly snapshot is the newest snapshot in a month. Defaults to all")
+
+    parser_plan = subparsers.add_parser('plan', help='Compute which snapshots of datasets have to be backuped and write them to a plan file')
+    parser_plan.add_argument('dataset_names', nargs='+',
+                             help="The names of the datasets to plan.")
+    parser_plan.add_argument('-o', '--output', required=True,
+                             help="The plan file to write.")
+    parser_plan.add_argument('-R', '--recursive', action='store_true',
+                             help="Treat the dataset names as prefixes and plan all filesystems below them.")
+    parser_plan.add_argument('-j', '--jobs', default=4, type=int,
+                             help="The number of datasets to plan in parallel. Defaults to 4")
+    parser_plan.add_argument('-q', '--quiet', action='store_true',
+                             help="Only print a summary instead of every planned snapshot.")
+    parser_plan.add_argument('--keep-last-n', default=None, type=int,
+                             help="Keep the last n snapshots. Defaults to all")
+    parser_plan.add_argument('--keep-weekly-n', default=None, type=int,
+                             help="Keep the last n weekly snapshots. A weekly snapshot is the newest snapshot in a week. Defaults to all")
+    parser_plan.add_argument('--keep-monthly-n', default=None, type=int,
+                             help="Keep the last n monthly snapshots. A monthly snapshot is the newest snapshot in a month. Defaults to all")
+
+    parser_execute = subparsers.add_parser('execute', help='Backup the snapshots of a plan file')
+    parser_execute.add_argument('plan_file',
+                                help="The plan file written by the plan command.")
+    parser_execute.add_argument('-j', '--jobs', default=4, type=int,
+                                help="The number of datasets to backup in parallel. Defaults to 4")
+
     args = parser.parse_args()
+    if args.diff_jobs < 1:
+        parser.error("--diff-jobs must be at least 1")
+    if args.zfs_jobs < 1:
+        parser.error("--zfs-jobs must be at least 1")
+    if args.restic_jobs < 1:
+        parser.error("--restic-jobs must be at least 1")
+    if args.check_every_n is not None:
+        if args.check_every_n < 1:
+            parser.error("--check-every-n must be at least 1")
+        # Without a journal the backuped snapshots are only counted within one run, e.g. a single one for next_snapshot_in_dataset
+        if args.journal is None:
+            parser.error("--check-every-n needs --journal to count the backuped snapshots across runs")
 
-    backuper = Backuper(restic_repo_prefix=args.restic_repo_prefix, zfs_dataset_common_prefix=args.zfs_dataset_common_prefix, restic_password_file=args.restic_password_file, dry_run=args.dry_run)
+    _executor.configure(limits={"zfs": args.zfs_jobs, "restic": args.restic_jobs},
+                        timeouts={"zfs": args.zfs_timeout, "restic": args.restic_timeout})
+    backuper = Backuper(restic_repo_prefix=args.restic_repo_prefix, zfs_dataset_common_prefix=args.zfs_dataset_common_prefix, restic_password_file=args.restic_password_file, dry_run=args.dry_run,
+                        cache_dir=args.cache_dir, diff_jobs=args.diff_jobs,
+                        metrics=MigrationMetrics(metrics_file=args.metrics_file, prometheus_file=args.prometheus_file),
+                        journal=MigrationJournal(args.journal) if args.journal is not None else None,
+                        check_policy=CheckPolicy(mode=args.check, read_data_subset=args.check_read_data_subset, every_n=args.check_every_n),
+                        throttle=PressureThrottle(io_target=args.io_pressure_target, cpu_target=args.cpu_pressure_target,
+                                                  stop_threshold=args.pressure_stop, upload_limit=args.throttle_upload_limit,
+                                                  max_pause=args.max_pressure_pause)
+                        if args.io_pressure_target is not None or args.cpu_pressure_target is not None or args.pressure_stop is not None else None)
 
-    if args.subparser_name == "single_snapshot":
-        if args.parent_snapshot is None:
-            print("Caution: No parent specified. This can greatly reduce performance.")
-        backuper.backup_single_snapshot(dataset_name=args.dataset_name, snapshot_name=args.snapshot_name, parent_restic_snapshot=args.parent_snapshot)
-    elif args.subparser_name == "next_snapshot_in_dataset":
-        backuper.backup_next_snapshot_from_dataset(dataset_name=args.dataset_name, keep_last_n=args.keep_last_n, keep_weekly_n=args.keep_weekly_n, keep_monthly_n=args.keep_monthly_n)
-    elif args.subparser_name == "dataset":
-        backuper.backup_dataset(dataset_name=args.dataset_name, keep_last_n=args.keep_last_n, keep_weekly_n=args.keep_weekly_n, keep_monthly_n=args.keep_monthly_n)
+    try:
+        if args.subparser_name == "single_snapshot":
+            if args.parent_snapshot is None:
+                print("Caution: No parent specified. This can greatly reduce performance.")
+            backuper.backup_single_snapshot(dataset_name=args.dataset_name, snapshot_name=args.snapshot_name, parent_restic_snapshot=args.parent_snapshot)
+        elif args.subparser_name == "next_snapshot_in_dataset":
+            backuper.backup_next_snapshot_from_dataset(dataset_name=args.dataset_name, keep_last_n=args.keep_last_n, keep_weekly_n=args.keep_weekly_n, keep_monthly_n=args.keep_monthly_n)
+        elif args.subparser_name == "dataset":
+            backuper.backup_dataset(dataset_name=args.dataset_name, keep_last_n=args.keep_last_n, keep_weekly_n=args.keep_weekly_n, keep_monthly_n=args.keep_monthly_n)
+        elif args.subparser_name == "datasets":
+            if args.jobs < 1:
+                parser.error("--jobs must be at least 1")
+            if not backuper.backup_datasets(dataset_names=args.dataset_names, recursive=args.recursive, jobs=args.jobs,
+                                            keep_last_n=args.keep_last_n, keep_weekly_n=args.keep_weekly_n, keep_monthly_n=args.keep_monthly_n):
+                exit(1)
+        elif args.subparser_name == "plan":
+            plan = backuper.plan(dataset_names=args.dataset_names, recursive=args.recursive, jobs=args.jobs,
+                                 keep_last_n=args.keep_last_n, keep_weekly_n=args.keep_weekly_n, keep_monthly_n=args.keep_monthly_n)
+            _print_plan(plan, verbose=not args.quiet)
+            with open(args.output + ".tmp", "w") as f:
+                json.dump(plan, f, indent=1)
+            os.replace(args.output + ".tmp", args.output)
+            print(f"Wrote plan to {args.output}.")
+        elif args.subparser_name == "execute":
+            with open(args.plan_file) as f:
+                plan = json.load(f)
+            if not backuper.execute_plan(plan, jobs=args.jobs):
+                exit(1)
+    except KeyboardInterrupt:
+        backuper.cancel()
+        exit(130)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,95 @@
-from bdb import effective
-from typing import Dict, List, Any, Tuple, Optional
+from typing import Dict, List, Any, Tuple, Optional, BinaryIO, Iterator
+import io
+import os
+import re
+import sys
+import math
+import mmap
 import json
+import time
+import array
+import bisect
+import struct
+import string
+import gzip
+import heapq
+import hashlib
+import datetime
+import argparse
+import itertools
+import contextlib
+import threading
+import subprocess
+import collections
+import multiprocessing
 
-import fileinput
 import shutil
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 HEADER_COLUMNS = [["time", "timestamp"],["level", "severity"],["message", "msg"]]
 HEADER_DELIMITER= " "
+READ_CHUNK_SIZE = 1024 * 1024
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+TIME_COLUMN = 0
+INDEX_SUFFIX = ".tidx"
+INDEX_MAGIC = b"PJLTIDX1"
+# magic, indexed size of the log, sha256 of its first INDEX_FINGERPRINT_SIZE bytes
+INDEX_HEADER = struct.Struct("<8sQ32s")
+# block offset, earliest and latest time in the block (inf and -inf without times)
+INDEX_RECORD = struct.Struct("<Qdd")
+INDEX_BLOCK_SIZE = 64 * 1024
+INDEX_FINGERPRINT_SIZE = 4096
+FOLLOW_INTERVAL = 0.5
+MERGE_FLUSH_LINES = 10000
+LAYOUT_CACHE_SIZE = 10000
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class Output:
+    """
+    Collects rendered lines and writes them to `stream` in large blocks instead of one write per line.
+    The lines are appended to `lines` directly and written by `flush`, which is called once per block of input lines.
+    """
+    def __init__(self, stream: Optional[BinaryIO]):
+        self.stream = stream
+        self.lines: List[str] = []
+
+    def take(self) -> bytes:
+        """Return the collected lines encoded and forget them."""
+        if len(self.lines) == 0:
+            return b""
+        self.lines.append("")
+        data = "\n".join(self.lines).encode(errors="backslashreplace")
+        self.lines = []
+        return data
+
+    def flush(self):
+        data = self.take()
+        if len(data) > 0:
+            self.stream.write(data)
+            self.stream.flush()
+
 
 def print_string(string: str, indent: int, continued_add_indent: int = 4):
-    remaining_string = string
-    effective_indent = indent
-    while len(remaining_string) > 0:
-        data_width = term_width - effective_indent
-        string_part = remaining_string[0:data_width]
-        remaining_string = remaining_string[data_width:]
-        print(" "*effective_indent + string_part)
-        if effective_indent == indent:
-            effective_indent += continued_add_indent
+    """Print `string` wrapped at the terminal width. The continuation lines are indented by `continued_add_indent` more."""
+    data_width = max(1, term_width - indent)
+    if len(string) <= data_width:
+        # Most values fit into a single line
+        if len(string) > 0:
+            output.lines.append(" " * indent + string)
+        return
+    output.lines.append(" " * indent + string[0:data_width])
+    # The parts are sliced by position, which stays linear for multi megabyte values
+    continued_indent = " " * (indent + continued_add_indent)
+    continued_width = max(1, term_width - indent - continued_add_indent)
+    for position in range(data_width, len(string), continued_width):
+        output.lines.append(continued_indent + string[position:position + continued_width])
 
 
 def get_header_value(entry: Dict[str,Any], col_idx: int) -> Tuple[Optional[str], str]:
@@ -27,70 +99,692 @@ def get_header_value(entry: Dict[str,Any], col_idx: int) -> Tuple[Optional[str],
             return col_name, entry[col_name]
     return None, ""
 
-def print_header(entry: Dict[str,Any]) -> List[str]:
-    """Print the header for the entry and return the consumed keys."""
-    consumed_keys = []
-    header_values = []
-    for col in range(0, len(HEADER_COLUMNS)):
-        key, value = get_header_value(entry, col)
-        header_values.append(value)
-        if key is not None:
-            consumed_keys.append(key)
-    header_str = HEADER_DELIMITER.join(header_values)
-    print_string(header_str, 0)
-    return consumed_keys
-
-def _print_attributes_list(attributes: List[Any], indent: int, prefix=""):
-    first = True
-    for attribute in attributes:
-        if first:
-            print_attributes(attribute, indent, prefix + "- ")
-            first = False
-        else:
-            print_attributes(attribute, indent + len(prefix), "- ")
-
-def _print_attributes_dict(attributes: Dict[str, Any], indent: int, prefix=""):
-    key_length = 0
-    for key in attributes:
-        k_l = len(key)
-        if k_l > key_length:
-            key_length = k_l
-
-    first = True
-    for key, value in attributes.items():
-        padded_key = key.ljust(key_length) + ": "
-        if first:
-            print_attributes(value, indent, prefix + padded_key)
-            first = False
+
+# Our services log the same shapes over and over, so the layout is computed once per set of keys
+_key_layouts: Dict[Tuple[str, ...], List[str]] = {}
+_entry_layouts: Dict[Tuple[str, ...], Tuple[List[Optional[str]], List[str], List[str]]] = {}
+
+
+def _get_key_layout(keys: Tuple[str, ...]) -> List[str]:
+    """Return the keys of a dict padded to the same length, followed by ": "."""
+    layout = _key_layouts.get(keys)
+    if layout is None:
+        if len(_key_layouts) >= LAYOUT_CACHE_SIZE:
+            _key_layouts.clear()
+        key_length = max(map(len, keys), default=0)
+        layout = _key_layouts[keys] = [key.ljust(key_length) + ": " for key in keys]
+    return layout
+
+
+def _get_entry_layout(entry: Dict[str, Any]) -> Tuple[List[Optional[str]], List[str], List[str]]:
+    """Return the keys of the header columns (None if missing), the remaining keys and their padded keys of an entry."""
+    keys = tuple(entry)
+    layout = _entry_layouts.get(keys)
+    if layout is None:
+        if len(_entry_layouts) >= LAYOUT_CACHE_SIZE:
+            _entry_layouts.clear()
+        header_keys = [get_header_value(entry, col)[0] for col in range(0, len(HEADER_COLUMNS))]
+        remaining_keys = [key for key in keys if key not in header_keys]
+        layout = _entry_layouts[keys] = (header_keys, remaining_keys, _get_key_layout(tuple(remaining_keys)))
+    return layout
+
+
+def _print_items(items: Iterator[Tuple[Any, int, str]]):
+    """
+    Print the (value, indent, prefix) items. Nested lists and dicts are rendered with an explicit stack of item iterators
+    instead of recursion, so arbitrarily deep values do not hit the recursion limit.
+    The first item of a list or dict continues the line of its parent's prefix, the others are indented below it.
+    """
+    lines = output.lines
+    width = term_width
+    stack = [items]
+    while len(stack) > 0:
+        for value, indent, prefix in stack[-1]:
+            if isinstance(value, dict):
+                if len(value) > 0:
+                    padded_keys = _get_key_layout(tuple(value))
+                    stack.append(zip(value.values(), itertools.chain((indent,), itertools.repeat(indent + len(prefix))),
+                                     itertools.chain((prefix + padded_keys[0],), itertools.islice(padded_keys, 1, None))))
+                    break
+            elif isinstance(value, list):
+                if len(value) > 0:
+                    stack.append(zip(value, itertools.chain((indent,), itertools.repeat(indent + len(prefix))),
+                                     itertools.chain((prefix + "- ",), itertools.repeat("- "))))
+                    break
+            else:
+                string = prefix + str(value)
+                if len(string) <= width - indent:
+                    # Inlined fast path of print_string
+                    if len(string) > 0:
+                        lines.append(" " * indent + string)
+                else:
+                    print_string(string, indent, len(prefix))
         else:
-            print_attributes(value, indent + len(prefix), padded_key)
+            stack.pop()
+
 
 def print_attributes(attributes: Any, indent: int = 2, prefix=""):
-    if isinstance(attributes, list):
-        _print_attributes_list(attributes, indent, prefix)
-    elif isinstance(attributes, dict):
-        _print_attributes_dict(attributes, indent, prefix)
-    else:
-        print_string(prefix + str(attributes), indent, len(prefix))
+    _print_items(iter([(attributes, indent, prefix)]))
+
 
 def print_entry(entry: Dict[str,Any]):
-    counsumed_keys = print_header(entry)
-    remaining_entry = {k:v for k,v in entry.items() if k not in counsumed_keys}
-    print_attributes(remaining_entry)
+    if not isinstance(entry, dict):
+        print_attributes(entry)
+        return
+    header_keys, remaining_keys, padded_keys = _get_entry_layout(entry)
+    print_string(HEADER_DELIMITER.join(["" if key is None else str(entry[key]) for key in header_keys]), 0)
+    _print_items(zip([entry[key] for key in remaining_keys], itertools.repeat(2), padded_keys))
 
 
-def main():
-    global term_width
-    term_width = shutil.get_terminal_size((80, 20)).columns
+LEVELS = ["trace", "debug", "info", "notice", "warning", "error", "critical", "alert", "emergency"]
+LEVEL_ALIASES = {"warn": "warning", "err": "error", "crit": "critical", "fatal": "critical", "panic": "emergency"}
+FILTER_OPERATORS = ["!=", ">=", "<=", "=", "~", ">", "<"]
+# Characters which every JSON encoder writes as they are and which are no JSON syntax, so a value made of them appears
+# literally in the raw line, no matter whether it is compared with a string or with the encoding of a list or object
+JSON_LITERAL_CHARACTERS = set(string.ascii_letters + string.digits + "_-.@")
+REGEX_LITERAL_CHARACTERS = set(string.ascii_letters + string.digits + "_-@")
+
+
+def normalize_level(level: Any) -> str:
+    level = str(level).lower()
+    return LEVEL_ALIASES.get(level, level)
 
-    for line in fileinput.input():
+
+def parse_time(value: Any) -> Optional[float]:
+    """Return a timestamp as seconds since the epoch, from a number or an ISO 8601 string, or None."""
+    if isinstance(value, str):
         try:
-            data = json.loads(line)
-        except:
-            print(f"Failed to load line as json: {line}")
-            continue
+            value = float(value)
+        except ValueError:
+            try:
+                return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+            except ValueError:
+                return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    # Values after the year 5000 are in milliseconds
+    return value / 1000 if value > 1e11 else float(value)
+
+
+def _to_text(value: Any) -> str:
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def _to_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _compare(a: Any, operator: str, b: Any) -> bool:
+    if operator == "=":
+        return a == b
+    elif operator == "!=":
+        return a != b
+    elif operator == ">=":
+        return a >= b
+    elif operator == "<=":
+        return a <= b
+    elif operator == ">":
+        return a > b
+    else:
+        return a < b
+
+
+class Filter:
+    """
+    A filter expression `KEY OPERATOR VALUE` like `level>=warning`, `msg~timed out` or `user.name=alice`.
+    KEY is a header column (time, level or message, matching all names in HEADER_COLUMNS) or a key of the entry,
+    with dots for nested keys. The operators are =, !=, <, <=, >, >= and ~ for a regular expression search.
+    Levels are ordered by severity, times are compared as timestamps, numbers numerically and everything else as text.
+    """
+    def __init__(self, expression: str):
+        positions = [(expression.find(operator), -len(operator), operator) for operator in FILTER_OPERATORS if operator in expression]
+        if len(positions) == 0:
+            raise ValueError(f"Filter {expression!r} has none of the operators {' '.join(FILTER_OPERATORS)}")
+        position, _, self.operator = min(positions)
+        self.key = expression[:position].strip()
+        self.value = expression[position + len(self.operator):].strip()
+        self.column = None
+        for col_idx, col_names in enumerate(HEADER_COLUMNS):
+            if self.key in col_names:
+                self.column = col_idx
+        self.path = self.key.split(".")
+        self.is_level = self.column is not None and "level" in HEADER_COLUMNS[self.column]
+        self.is_time = self.column is not None and "time" in HEADER_COLUMNS[self.column]
+
+        self.regex = re.compile(self.value) if self.operator == "~" else None
+        self.number = _to_number(self.value)
+        self.time = parse_time(self.value) if self.is_time else None
+        if self.is_time and self.time is None:
+            raise ValueError(f"Filter {expression!r} has no valid time, use seconds since the epoch or ISO 8601")
+        self.level = normalize_level(self.value)
+        if self.is_level and self.operator not in ("=", "!=", "~") and self.level not in LEVELS:
+            raise ValueError(f"Filter {expression!r} has an unknown level, use one of {' '.join(LEVELS)}")
+        self.needle = self._get_needle()
+
+    def _get_needle(self) -> Optional["re.Pattern[bytes]"]:
+        """Return a pattern which occurs in every raw line this filter can match, or None if there is none."""
+        if self.is_level and self.operator not in ("!=", "~"):
+            levels = [level for level in LEVELS if _compare(LEVELS.index(level), self.operator, LEVELS.index(self.level))] \
+                if self.level in LEVELS else [self.level]
+            names = [name for name in [*LEVELS, *LEVEL_ALIASES] if normalize_level(name) in levels] or [self.level]
+            if not all(c in JSON_LITERAL_CHARACTERS for name in names for c in name):
+                return None
+            return re.compile("|".join(re.escape(name) for name in names).encode(), re.IGNORECASE)
+        if self.operator == "=" and not self.is_time and self.number is None and len(self.value) > 0 \
+                and all(c in JSON_LITERAL_CHARACTERS for c in self.value):
+            return re.compile(re.escape(self.value).encode())
+        if self.operator == "~" and len(self.value) > 0 and all(c in REGEX_LITERAL_CHARACTERS for c in self.value):
+            return re.compile(self.value.encode())
+        return None
+
+    def may_match(self, line: bytes) -> bool:
+        """Cheaply check the raw line. False means the entry of the line can not match."""
+        return self.needle is None or self.needle.search(line) is not None
+
+    def _get_value(self, entry: Dict[str, Any]) -> Tuple[bool, Any]:
+        if self.column is not None:
+            key, value = get_header_value(entry, self.column)
+            return key is not None, value
+        if self.key in entry:
+            return True, entry[self.key]
+        value = entry
+        for part in self.path:
+            if not isinstance(value, dict) or part not in value:
+                return False, None
+            value = value[part]
+        return True, value
+
+    def matches(self, entry: Dict[str, Any]) -> bool:
+        found, value = self._get_value(entry)
+        if not found:
+            return self.operator == "!="
+        if self.operator == "~":
+            return self.regex.search(_to_text(value)) is not None
+        if self.is_level:
+            level = normalize_level(value)
+            if self.operator in ("=", "!="):
+                return _compare(level, self.operator, self.level)
+            return level in LEVELS and _compare(LEVELS.index(level), self.operator, LEVELS.index(self.level))
+        if self.is_time:
+            time = parse_time(value)
+            return time is not None and _compare(time, self.operator, self.time)
+        number = _to_number(value) if self.number is not None else None
+        if number is not None:
+            return _compare(number, self.operator, self.number)
+        return _compare(_to_text(value), self.operator, self.value)
+
+
+filters: List[Filter] = []
+
+
+def parse_filter(expression: str) -> Filter:
+    try:
+        return Filter(expression)
+    except (ValueError, re.error) as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _read_line_blocks(f: BinaryIO, size: Optional[int] = None) -> Iterator[List[bytes]]:
+    """Yield the lines of `f` from its current position, at most `size` bytes if given."""
+    rest = b""
+    while size is None or size > 0:
+        # read1 returns what is available, so piped logs are rendered as soon as they arrive
+        chunk = f.read1(READ_CHUNK_SIZE if size is None else min(READ_CHUNK_SIZE, size))
+        if len(chunk) == 0:
+            break
+        if size is not None:
+            size -= len(chunk)
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield lines
+    if len(rest) > 0:
+        yield [rest]
+
+
+def read_line_blocks(file_names: List[str], ranges: Dict[str, Tuple[int, int]] = {}) -> Iterator[List[bytes]]:
+    """
+    Yield the lines of all files, or stdin if there are none or for "-", in blocks read in binary chunks.
+    Only the (start, end) byte range in `ranges` is read of a file if it has one.
+    """
+    for file_name in file_names or ["-"]:
+        with open_log(file_name) as f:
+            # Files with ranges are never compressed, see is_compressed
+            start, end = ranges.get(file_name, (0, None))
+            if start > 0:
+                f.seek(start)
+            yield from _read_line_blocks(f, None if end is None else end - start)
+
+
+def _get_compression(f: io.BufferedReader) -> Optional[str]:
+    head = f.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    elif head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+def is_compressed(file_name: str) -> bool:
+    with open(file_name, "rb") as f:
+        return _get_compression(f) is not None
+
+
+def _copy_stream(source: BinaryIO, destination: BinaryIO):
+    try:
+        while True:
+            chunk = source.read1(READ_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            destination.write(chunk)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            destination.close()
+        except BrokenPipeError:
+            pass
+
+
+@contextlib.contextmanager
+def open_log(file_name: str) -> Iterator[BinaryIO]:
+    """
+    Open a log file, or stdin for "-", for binary reading. gzip and zstd compressed logs are decompressed as a stream.
+    zstd uses the zstandard module if it is installed and the zstd command otherwise.
+    """
+    with contextlib.ExitStack() as stack:
+        f = sys.stdin.buffer if file_name == "-" else stack.enter_context(open(file_name, "rb"))
+        compression = _get_compression(f)
+        if compression == "gzip":
+            yield stack.enter_context(gzip.GzipFile(fileobj=f))
+        elif compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                if file_name != "-":
+                    process = stack.enter_context(subprocess.Popen(["zstd", "-dcq", file_name], stdout=subprocess.PIPE))
+                else:
+                    # stdin was already read into the buffer of f, so it is passed on to zstd from there
+                    process = stack.enter_context(subprocess.Popen(["zstd", "-dcq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+                    threading.Thread(target=_copy_stream, args=(f, process.stdin), daemon=True).start()
+                yield process.stdout
+                return
+            yield stack.enter_context(io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f)))
+        else:
+            yield f
+
+
+# Sentinels returned by decode_line
+REJECTED = object()
+NOT_JSON = object()
+
+
+def decode_line(line: bytes) -> Any:
+    """Decode a line, returns REJECTED if it does not match the filters and NOT_JSON if it is no JSON."""
+    for f in filters:
+        if not f.may_match(line):
+            return REJECTED
+    try:
+        data = json_loads(line)
+    except ValueError:
+        return REJECTED if len(filters) > 0 else NOT_JSON
+    for f in filters:
+        if not f.matches(data):
+            return REJECTED
+    return data
+
+
+def print_decoded(line: bytes, data: Any):
+    if data is NOT_JSON:
+        output.lines.append(f"Failed to load line as json: {line.decode(errors='replace')}")
+    else:
         print_entry(data)
 
 
+def print_line(line: bytes):
+    data = decode_line(line)
+    if data is not REJECTED:
+        print_decoded(line, data)
+
+
+def prettify_files(file_names: List[str], ranges: Dict[str, Tuple[int, int]] = {}):
+    for lines in read_line_blocks(file_names, ranges):
+        for line in lines:
+            print_line(line)
+        output.flush()
+
+
+def _iter_timed_entries(file_name: str, ranges: Dict[str, Tuple[int, int]]) -> Iterator[Tuple[float, bytes, Any]]:
+    """Yield the time, line and decoded entry of the lines of a file. Lines without time get the time of the line before."""
+    last_time = -math.inf
+    for lines in read_line_blocks([file_name], ranges):
+        for line in lines:
+            data = decode_line(line)
+            if data is REJECTED:
+                continue
+            if isinstance(data, dict):
+                time = parse_time(get_header_value(data, TIME_COLUMN)[1])
+                if time is not None:
+                    last_time = time
+            yield last_time, line, data
+
+
+def prettify_files_merged(file_names: List[str], ranges: Dict[str, Tuple[int, int]] = {}):
+    """
+    Render the entries of all files ordered by time, assuming each file is ordered by time.
+    The files are read as streams in parallel with a k-way merge, so only a block of lines per file is held in memory.
+    """
+    entries = heapq.merge(*[_iter_timed_entries(file_name, ranges) for file_name in file_names or ["-"]], key=lambda entry: entry[0])
+    for _, line, data in entries:
+        print_decoded(line, data)
+        if len(output.lines) >= MERGE_FLUSH_LINES:
+            output.flush()
+    output.flush()
+
+
+def get_time_range(filters: List[Filter]) -> Tuple[Optional[float], Optional[float]]:
+    """Return the earliest and latest time the time filters allow, None if unbounded."""
+    since, until = None, None
+    for f in filters:
+        if not f.is_time:
+            continue
+        if f.operator in (">=", ">", "="):
+            since = f.time if since is None else max(since, f.time)
+        if f.operator in ("<=", "<", "="):
+            until = f.time if until is None else min(until, f.time)
+    return since, until
+
+
+class TimeIndex:
+    """
+    Sidecar index of a log file for time range queries. The file is split into blocks of about INDEX_BLOCK_SIZE
+    bytes at line boundaries and for each block its offset and the earliest and latest time of its lines are stored.
+    As logs are appended to, only the data after the indexed part is read when the index is updated.
+    The lines do not have to be ordered by time, the range of blocks which can contain a time is found by binary search
+    over the running maximum and the minimum of all following blocks.
+    """
+    def __init__(self, log_file: str, index_file: Optional[str] = None):
+        self.log_file = log_file
+        self.index_file = index_file if index_file is not None else get_index_file(log_file)
+        self._clear()
+
+    def _clear(self):
+        self.indexed_size = 0
+        self.fingerprint = b""
+        self.offsets = array.array("Q")
+        self.min_times = array.array("d")
+        self.max_times = array.array("d")
+
+    def _get_fingerprint(self, f: BinaryIO, size: int) -> bytes:
+        """Identify the file by its beginning, which changes if the log is rotated or replaced."""
+        f.seek(0)
+        return hashlib.sha256(f.read(min(size, INDEX_FINGERPRINT_SIZE))).digest()
+
+    def load(self):
+        try:
+            with open(self.index_file, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(data) < INDEX_HEADER.size:
+            return
+        magic, indexed_size, fingerprint = INDEX_HEADER.unpack_from(data)
+        records = data[INDEX_HEADER.size:]
+        if magic != INDEX_MAGIC or len(records) % INDEX_RECORD.size != 0:
+            return
+        self.indexed_size, self.fingerprint = indexed_size, fingerprint
+        for offset, min_time, max_time in INDEX_RECORD.iter_unpack(records):
+            self.offsets.append(offset)
+            self.min_times.append(min_time)
+            self.max_times.append(max_time)
+
+    def save(self):
+        data = bytearray(INDEX_HEADER.pack(INDEX_MAGIC, self.indexed_size, self.fingerprint))
+        for record in zip(self.offsets, self.min_times, self.max_times):
+            data += INDEX_RECORD.pack(*record)
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+        with open(self.index_file + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+    def update(self):
+        """Load the index and index the data appended to the log since. Rebuilds it if the log was replaced."""
+        self.load()
+        with open(self.log_file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.indexed_size or self._get_fingerprint(f, self.indexed_size) != self.fingerprint:
+                self._clear()
+            if size == self.indexed_size:
+                return
+            f.seek(self.indexed_size)
+            offset = self.indexed_size
+            block_start, block_min, block_max = offset, math.inf, -math.inf
+            for lines in _read_line_blocks(f, size - offset):
+                for line in lines:
+                    if offset + len(line) + 1 > size:
+                        # A last line without newline may still be written, it is indexed next time
+                        break
+                    offset += len(line) + 1
+                    try:
+                        _, value = get_header_value(json_loads(line), TIME_COLUMN)
+                    except (ValueError, TypeError):
+                        value = None
+                    time = parse_time(value)
+                    if time is not None:
+                        block_min, block_max = min(block_min, time), max(block_max, time)
+                    if offset - block_start >= INDEX_BLOCK_SIZE:
+                        self._add_block(block_start, block_min, block_max)
+                        block_start, block_min, block_max = offset, math.inf, -math.inf
+                        self.indexed_size = offset
+            if offset > block_start:
+                self._add_block(block_start, block_min, block_max)
+                self.indexed_size = offset
+            self.fingerprint = self._get_fingerprint(f, self.indexed_size)
+        self.save()
+
+    def _add_block(self, offset: int, min_time: float, max_time: float):
+        self.offsets.append(offset)
+        self.min_times.append(min_time)
+        self.max_times.append(max_time)
+
+    def find_range(self, since: Optional[float], until: Optional[float]) -> Tuple[int, int]:
+        """Return the byte range of the indexed part of the log which contains all lines between `since` and `until`."""
+        start, end = 0, self.indexed_size
+        if since is not None:
+            # All lines before the block after the last block with a running maximum before `since` are too early
+            running_max = list(itertools.accumulate(self.max_times, max))
+            block = bisect.bisect_left(running_max, since)
+            start = self.offsets[block] if block < len(self.offsets) else self.indexed_size
+        if until is not None:
+            # All lines from the first block whose following blocks are all later than `until` on are too late
+            following_min = list(itertools.accumulate(reversed(self.min_times), min))[::-1]
+            block = bisect.bisect_right(following_min, until)
+            end = self.offsets[block] if block < len(self.offsets) else self.indexed_size
+        return start, max(start, end)
+
+
+def get_index_file(log_file: str) -> str:
+    """Return the sidecar index file of `log_file`, in the cache dir if the directory of the log is not writable."""
+    log_file = os.path.abspath(log_file)
+    if os.access(os.path.dirname(log_file), os.W_OK):
+        return log_file + INDEX_SUFFIX
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "prettifyJsonLog")
+    name = hashlib.sha256(log_file.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(log_file)}-{name}{INDEX_SUFFIX}")
+
+
+def _find_last_lines(f: BinaryIO, num_lines: int) -> int:
+    """Return the offset of the last `num_lines` complete lines of `f`, reading it backwards."""
+    position = os.fstat(f.fileno()).st_size
+    # The lines start after the newline before them. A last line without newline is still being written and not counted.
+    num_newlines = -1
+    while position > 0:
+        chunk_start = max(0, position - READ_CHUNK_SIZE)
+        f.seek(chunk_start)
+        chunk = f.read(position - chunk_start)
+        i = chunk.rfind(b"\n")
+        while i != -1:
+            num_newlines += 1
+            if num_newlines == num_lines:
+                return chunk_start + i + 1
+            i = chunk.rfind(b"\n", 0, i)
+        position = chunk_start
+    return 0
+
+
+def follow_file(file_name: str, num_lines: int):
+    """
+    Render the last `num_lines` lines of `file_name` and then the lines appended to it, like `tail -F`.
+    The file is polled at its current position, so it is never read again from the start unless it is rotated or truncated.
+    """
+    f = open(file_name, "rb")
+    f.seek(_find_last_lines(f, num_lines))
+    rest = b""
+    try:
+        while True:
+            chunk = f.read1(READ_CHUNK_SIZE)
+            if len(chunk) > 0:
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop()
+                for line in lines:
+                    print_line(line)
+                output.flush()
+                continue
+            time.sleep(FOLLOW_INTERVAL)
+            try:
+                stat = os.stat(file_name)
+            except FileNotFoundError:
+                continue
+            if stat.st_ino != os.fstat(f.fileno()).st_ino or stat.st_size < f.tell():
+                # The log was rotated or truncated, the old file was read to its end
+                f.close()
+                f = open(file_name, "rb")
+                rest = b""
+    finally:
+        f.close()
+
+
+def split_at_lines(data: mmap.mmap, chunk_size: int, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Split `data` from `start` to `end` into (start, end) ranges of roughly `chunk_size` bytes which end after a newline."""
+    end = len(data) if end is None else end
+    ranges = []
+    while start < end:
+        chunk_end = data.find(b"\n", start + chunk_size, end)
+        chunk_end = end if chunk_end == -1 else chunk_end + 1
+        ranges.append((start, chunk_end))
+        start = chunk_end
+    return ranges
+
+
+_mapped_files: Dict[str, mmap.mmap] = {}
+
+
+def _init_worker(width: int, worker_filters: List[Filter]):
+    global term_width, output, filters
+    term_width = width
+    output = Output(None)
+    filters = worker_filters
+
+
+def _render_chunk(file_name: str, start: int, end: int) -> bytes:
+    """Render the lines in the byte range of `file_name` in a worker process and return the output."""
+    if file_name not in _mapped_files:
+        with open(file_name, "rb") as f:
+            _mapped_files[file_name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    lines = _mapped_files[file_name][start:end].split(b"\n")
+    if len(lines[-1]) == 0:
+        lines.pop()
+    for line in lines:
+        print_line(line)
+    return output.take()
+
+
+def prettify_files_parallel(file_names: List[str], jobs: int, ranges: Dict[str, Tuple[int, int]] = {}):
+    """
+    Like `prettify_files`, but the chunks of regular files are rendered by `jobs` processes.
+    The output keeps the order of the input. Other files, like pipes or compressed files, are rendered sequentially.
+    """
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(term_width, filters)) as pool:
+        for file_name in file_names or ["-"]:
+            if file_name == "-" or not os.path.isfile(file_name) or os.path.getsize(file_name) == 0 or is_compressed(file_name):
+                prettify_files([file_name], ranges)
+                continue
+            with open(file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                chunks = split_at_lines(data, PARALLEL_CHUNK_SIZE, *ranges.get(file_name, (0, None)))
+            # Only a few chunks are in flight, so the rendered output does not pile up in memory if stdout is slow
+            pending: collections.deque = collections.deque()
+            for start, end in chunks:
+                pending.append(pool.apply_async(_render_chunk, (file_name, start, end)))
+                if len(pending) >= 2 * jobs:
+                    output.stream.write(pending.popleft().get())
+            while len(pending) > 0:
+                output.stream.write(pending.popleft().get())
+            output.stream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render JSON logs, one entry per line, human readable.')
+    parser.add_argument('files', nargs='*',
+                        help="The log files to render, gzip and zstd compressed files are decompressed. Reads stdin if none or - is given.")
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help="Render files with this many processes, 0 uses all cores. Pipes are always rendered by one. Defaults to 1")
+    parser.add_argument('-f', '--filter', action='append', default=[], type=parse_filter, dest='filters', metavar='EXPRESSION',
+                        help="Only render entries matching the filter, e.g. 'level>=warning', 'time>=2024-05-01T03:00', "
+                             "'msg~timed? out' or 'user.name=alice'. Can be given multiple times, all filters must match.")
+    parser.add_argument('-i', '--index', action='store_true',
+                        help=f"Use a sidecar index of the times in the files ({INDEX_SUFFIX}, created and updated as needed) to seek "
+                             "directly to the range of time filters instead of reading the whole files.")
+    parser.add_argument('-m', '--merge', action='store_true',
+                        help="Render the entries of all files ordered by their time instead of one file after the other. "
+                             "Each file has to be ordered by time.")
+    parser.add_argument('-F', '--follow', action='store_true',
+                        help="Render the last lines of the last file and then the lines appended to it, like tail -F.")
+    parser.add_argument('-n', '--lines', default=10, type=int,
+                        help="The number of last lines --follow starts with. Defaults to 10")
+    args = parser.parse_args()
+    if args.follow and (len(args.files) == 0 or args.files[-1] == "-"):
+        parser.error("--follow needs a file")
+
+    global term_width, output, filters
+    filters = args.filters
+    term_width = shutil.get_terminal_size((80, 20)).columns
+    output = Output(sys.stdout.buffer)
+
+    files = args.files[:-1] if args.follow else args.files
+    ranges: Dict[str, Tuple[int, int]] = {}
+    since, until = get_time_range(filters)
+    if args.index and (since is not None or until is not None):
+        for file_name in files:
+            if file_name != "-" and os.path.isfile(file_name) and not is_compressed(file_name):
+                index = TimeIndex(file_name)
+                index.update()
+                ranges[file_name] = index.find_range(since, until)
+
+    jobs = args.jobs or os.cpu_count()
+    try:
+        if len(files) > 0 or not args.follow:
+            if args.merge:
+                prettify_files_merged(files, ranges)
+            elif jobs > 1:
+                prettify_files_parallel(files, jobs, ranges)
+            else:
+                prettify_files(files, ranges)
+        if args.follow:
+            follow_file(args.files[-1], args.lines)
+    except BrokenPipeError:
+        # The reader, e.g. head or less, exited. Avoid another error when stdout is flushed at exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except KeyboardInterrupt:
+        output.flush()
+        sys.exit(130)
+
+
 if __name__ == "__main__":
     main()
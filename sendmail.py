@@ -2,8 +2,14 @@
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
+from email.header import Header
 from email import encoders
 import smtplib
+import argparse
+import threading
+import queue
+import json
+import time
 import csv
 import ssl
 import os
@@ -19,6 +25,11 @@ edit the user settings accordingly, USER_LIST ist the path to your csv file.
 if a attachment file should be appended, add its path and filename to the corresponding variable.
 if SMTP throws errors you can debug it by setting SMTP_DEBUG to True.
 to run just execute 'python sendmail.py'
+mails are sent over SMTP_CONNECTIONS reused connections, at most MAX_MAILS_PER_SECOND. temporary failures are retried.
+every recipient who got the mail is recorded in the journal (USER_LIST + '.sent'), so running the script again
+after an interruption or failures only sends the missing mails. delete the journal to send all mails again.
+to test without sending real mails start 'fake_backend/smtp_server --port 1025' and run
+'python sendmail.py --server localhost --port 1025 --no-starttls'. see 'python sendmail.py --help' for all options.
 """
 
 ### User Settings
@@ -32,6 +43,15 @@ USER_LIST = '/path/to/user_list.csv' # path to csv file to use
 SMTPserver = 'smtp.stuvus.uni-stuttgart.de'
 SMTPport = 587
 SMTP_DEBUG = False
+SMTP_STARTTLS = True # use STARTTLS and login, disable for a local test server
+
+### Delivery Settings
+SMTP_CONNECTIONS = 4 # number of parallel connections to the smtp server
+MAX_MAILS_PER_SECOND = 2 # over all connections, 0 for no limit
+MAX_MAILS_PER_CONNECTION = 100 # reconnect after this many mails, relays often limit it
+SEND_RETRIES = 3 # how often temporary failures are retried
+RETRY_DELAY = 5 # seconds before the first retry, doubled for every further retry
+JOURNAL = '' # recipients who got their mail, leave blank to use USER_LIST + '.sent'
 
 ### Edit Message Template here:
 subject = 'Stuvus Account eingerichtet'
@@ -55,14 +75,10 @@ attachment_path = '/path/to'
 attachment_name = 'attachment.pdf'
 
 context = ssl.create_default_context()
-d={}
-d['givenname']=[]
-d['sn']=[]
-d['pmail']=[]
-d['password']=[]
-d['uid']=[]
-
-def add_attachment(message):
+FIELDNAMES = ['givenname', 'sn', 'pmail', 'password', 'uid']
+
+def get_attachment():
+    """the attachment part, read and base64 encoded once for all mails. None if no attachment is set."""
     file = os.path.join(attachment_path,attachment_name)
     if(file):
         with open(file,'rb') as raw_file:
@@ -70,31 +86,254 @@ def add_attachment(message):
             obj.set_payload((raw_file.read()))
             encoders.encode_base64(obj)
             obj.add_header('Content-Disposition','attachment; filename='+attachment_name)
-            message.attach(obj)
+            return obj
+    return None
 
 
-with open(USER_LIST) as file:
-    input = csv.DictReader(file, fieldnames = ['givenname', 'sn', 'pmail', 'password', 'uid'], delimiter = ',')
-    for i,row in enumerate(input):
-        for key in row:
-            d[key].append(row[key])
-    print('read %i lines from %s'%(i+1,USER_LIST))
+class MessageTemplate:
+    """
+    the message serialized once with placeholders for the recipient and the text part.
+    building a mail only renders the personalised text part and joins it with the precompiled rest.
+    the mails are bytes with CRLF line endings, which smtplib sends as they are.
+    """
+    TO_PLACEHOLDER = '@@to@@'
 
-
-for i in range(0,len(d['sn'])):
+    def __init__(self):
+        placeholder = MIMEText('@@text@@', 'plain', 'us-ascii')
         message = MIMEMultipart()
         message['From'] = SENDER
-        message['To'] = d['pmail'][i]
+        message['To'] = self.TO_PLACEHOLDER
         message['Subject'] = subject
-        message.attach(MIMEText(body % (d['givenname'][i],d['sn'][i],d['uid'][i],d['password'][i],NAME),'plain', 'utf-8'))
-        add_attachment(message)
-        msg = message.as_string()
-        
-        with smtplib.SMTP(SMTPserver, SMTPport) as server:
-            server.set_debuglevel(SMTP_DEBUG)
-            server.ehlo()
-            server.starttls(context=context)
-            server.ehlo()
-            server.login(USERNAME, PASSWORD)
-            server.sendmail(SENDER, d['pmail'][i], msg)
-        print('email sent to: %s %s Mail: %s'%(d['givenname'][i],d['sn'][i],d['pmail'][i]))
\ No newline at end of file
+        message.attach(placeholder)
+        attachment = get_attachment()
+        if attachment is not None:
+            message.attach(attachment)
+        head, tail = message.as_string().split(placeholder.as_string(), 1)
+        self.head = head.replace('\n', '\r\n')
+        self.tail = tail.replace('\n', '\r\n').encode('ascii')
+
+    def render(self, row):
+        """raises ValueError for rows with missing or extra fields and for addresses which would inject further headers."""
+        # csv.DictReader puts missing fields as None and extra fields in a list under the key None
+        if None in row:
+            raise ValueError('more than the %i fields %s' % (len(FIELDNAMES), ', '.join(FIELDNAMES)))
+        missing = [field for field in FIELDNAMES if row.get(field) is None]
+        if missing:
+            raise ValueError('missing the fields %s' % ', '.join(missing))
+        if '\r' in row['pmail'] or '\n' in row['pmail']:
+            raise ValueError('line break in the address %r' % row['pmail'])
+        text = MIMEText(body % (row['givenname'],row['sn'],row['uid'],row['password'],NAME),'plain', 'utf-8')
+        # the address is encoded like message['To'] would do it, e.g. as utf-8 if it is not ascii
+        to = 'To: ' + Header(row['pmail'], header_name='To').encode(linesep='\r\n')
+        head = self.head.replace('To: ' + self.TO_PLACEHOLDER, to, 1)
+        return (head + text.as_string().replace('\n', '\r\n')).encode('ascii') + self.tail
+
+
+class RateLimiter:
+    """spaces out the mails of all connections to at most `rate` per second."""
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Journal:
+    """json lines of the recipients who got their mail, which are skipped when the script is run again."""
+    def __init__(self, path):
+        self.path = path
+        self.sent = set()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be incomplete if the script was killed while writing it
+                        continue
+                    self.sent.add((entry['pmail'], entry['uid']))
+
+    def is_sent(self, pmail, uid):
+        return (pmail, uid) in self.sent
+
+    def record(self, pmail, uid):
+        with self.lock:
+            self.sent.add((pmail, uid))
+            with open(self.path, 'a') as file:
+                file.write(json.dumps({'pmail': pmail, 'uid': uid, 'time': time.time()}) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+
+class ConnectError(Exception):
+    """connecting or logging in to the smtp server failed, the cause is the original error."""
+
+
+class Connection:
+    """a connection to the smtp server which is reused for many mails and reconnected when needed."""
+    def __init__(self, server, port, starttls):
+        self.server = server
+        self.port = port
+        self.starttls = starttls
+        self.smtp = None
+        self.num_sent = 0
+
+    def connect(self):
+        self.smtp = smtplib.SMTP(self.server, self.port, timeout=60)
+        self.smtp.set_debuglevel(SMTP_DEBUG)
+        self.smtp.ehlo()
+        if self.starttls:
+            self.smtp.starttls(context=context)
+            self.smtp.ehlo()
+            self.smtp.login(USERNAME, PASSWORD)
+        self.num_sent = 0
+
+    def send(self, recipient, msg):
+        if self.smtp is None or self.num_sent >= MAX_MAILS_PER_CONNECTION:
+            self.close()
+            try:
+                self.connect()
+            except (smtplib.SMTPException, OSError) as e:
+                raise ConnectError(e) from e
+        self.smtp.sendmail(SENDER, recipient, msg)
+        self.num_sent += 1
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
+
+
+def is_temporary(error):
+    """4xx replies and lost connections are worth a retry, 5xx replies and failed logins are not."""
+    if isinstance(error, ConnectError):
+        return not isinstance(error.__cause__, smtplib.SMTPAuthenticationError)
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # smtplib.SMTPException is an OSError as well, the others are errors of the socket.
+    # a UnicodeError of an address which is not ascii will not go away
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def send_mail(row, msg, connection, rate_limiter, journal, results):
+    """raises ConnectError if the smtp server can not be used at all, which stops the whole run."""
+    for attempt in range(SEND_RETRIES + 1):
+        rate_limiter.wait()
+        try:
+            connection.send(row['pmail'], msg)
+        except (ConnectError, smtplib.SMTPException, OSError, UnicodeError) as e:
+            # the state of the connection is unknown after an error
+            connection.close()
+            if isinstance(e, ConnectError) and (not is_temporary(e) or attempt == SEND_RETRIES):
+                raise
+            if not is_temporary(e) or attempt == SEND_RETRIES:
+                print('failed to send email to: %s %s Mail: %s (%r)'%(row['givenname'],row['sn'],row['pmail'],e))
+                results['failed'].append(row['pmail'])
+                break
+            delay = RETRY_DELAY * 2**attempt
+            print('temporary failure for %s, retrying in %gs (%r)'%(row['pmail'],delay,e))
+            time.sleep(delay)
+            continue
+        journal.record(row['pmail'], row['uid'])
+        results['sent'].append(row['pmail'])
+        print('email sent to: %s %s Mail: %s'%(row['givenname'],row['sn'],row['pmail']))
+        break
+
+
+def send_worker(jobs, connection, rate_limiter, journal, results, stop):
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        if stop.is_set():
+            # the run is stopped, the remaining jobs are only taken off the queue so main() never blocks
+            continue
+        row, msg = job
+        try:
+            send_mail(row, msg, connection, rate_limiter, journal, results)
+        except Exception as e:
+            # e.g. wrong credentials, which must not be tried again for every user, or a journal which can not be written
+            print('stopping all connections after the email to %s: %r'%(row['pmail'],e))
+            results['failed'].append(row['pmail'])
+            results['error'] = e
+            stop.set()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send the account mails to the users in a csv file, see the usage at the top of this file.')
+    parser.add_argument('--user-list', default=USER_LIST, help='the csv file with the users. defaults to USER_LIST')
+    parser.add_argument('--server', default=SMTPserver, help='the smtp server. defaults to SMTPserver')
+    parser.add_argument('--port', default=SMTPport, type=int, help='the smtp port. defaults to SMTPport')
+    parser.add_argument('--no-starttls', dest='starttls', action='store_false', default=SMTP_STARTTLS,
+                        help='connect without STARTTLS and login, e.g. to fake_backend/smtp_server')
+    parser.add_argument('--connections', default=SMTP_CONNECTIONS, type=int, help='the number of parallel connections. defaults to SMTP_CONNECTIONS')
+    parser.add_argument('--rate', default=MAX_MAILS_PER_SECOND, type=float, help='the maximum mails per second, 0 for no limit. defaults to MAX_MAILS_PER_SECOND')
+    parser.add_argument('--journal', default=JOURNAL, help="the journal of sent mails. defaults to JOURNAL or the user list + '.sent'")
+    args = parser.parse_args()
+
+    template = MessageTemplate()
+    journal = Journal(args.journal or args.user_list + '.sent')
+    rate_limiter = RateLimiter(args.rate)
+    results = {'sent': [], 'failed': [], 'error': None}
+    stop = threading.Event()
+    # a short queue, so only a few messages are built ahead of the connections
+    jobs = queue.Queue(maxsize=2 * args.connections)
+    workers = [threading.Thread(target=send_worker, args=(jobs, Connection(args.server, args.port, args.starttls), rate_limiter, journal, results, stop))
+               for _ in range(args.connections)]
+    for worker in workers:
+        worker.start()
+
+    skipped = 0
+    num_lines = 0
+    try:
+        # the users are read row by row while the mails are sent, not loaded at once
+        with open(args.user_list) as file:
+            for row in csv.DictReader(file, fieldnames = FIELDNAMES, delimiter = ','):
+                if stop.is_set():
+                    break
+                num_lines += 1
+                if journal.is_sent(row['pmail'], row['uid']):
+                    skipped += 1
+                    continue
+                try:
+                    msg = template.render(row)
+                except ValueError as e:
+                    # a broken row only fails its own mail
+                    print('failed to build email for line %i: %s %s Mail: %r (%r)'%(num_lines,row['givenname'],row['sn'],row['pmail'],e))
+                    results['failed'].append(row['pmail'] or 'line %i'%num_lines)
+                    continue
+                jobs.put((row, msg))
+    finally:
+        for worker in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+
+    print('read %i lines from %s'%(num_lines,args.user_list))
+    if results['error'] is not None:
+        print('stopped because of %r, the remaining users were not sent an email'%results['error'])
+    print('sent %i emails, %i failed, %i skipped because they were sent before'%(len(results['sent']),len(results['failed']),skipped))
+    if results['failed']:
+        print('failed: %s'%', '.join(results['failed']))
+        print('run the script again to retry the failed emails')
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file